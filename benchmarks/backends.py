@@ -0,0 +1,89 @@
+# Checks every INFERENCE_BACKEND against the fp32 eager baseline on the
+# bundled images: inlier counts, how far each backend's homography moves the
+# image corners compared to the baseline's, and per-pair latency.
+# run from the repository root: python -m benchmarks.backends --region stokowka
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import main
+
+BACKENDS = ("eager", "compile", "int8", "bf16")
+
+
+def parse_args():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--queries", default="./test-user-images")
+  parser.add_argument("--region", default="stokowka")
+  parser.add_argument("--limit", type=int, default=4, help="only use the first N query images")
+  parser.add_argument("--backends", nargs="*", default=list(BACKENDS))
+  parser.add_argument("--repeat", type=int, default=2, help="timed runs per pair after one warmup run")
+  return parser.parse_args()
+
+
+def corner_shift(H, H_baseline, w, h):
+  # mean distance between the query corners projected by both homographies
+  corners = np.float32([[0, 0], [w, 0], [w, h], [0, h]]).reshape(-1, 1, 2)
+  projected = cv2.perspectiveTransform(corners, H)
+  baseline = cv2.perspectiveTransform(corners, H_baseline)
+  return float(np.linalg.norm(projected - baseline, axis=2).mean())
+
+
+def evaluate(pairs, repeat):
+  results = []
+  for query, reference in pairs:
+    main.match_image_pairs([(query["gray"], reference["gray"])])
+    timings = []
+    for _ in range(repeat):
+      start = time.perf_counter()
+      mkpts0, mkpts1 = main.match_image_pairs([(query["gray"], reference["gray"])])[0]
+      timings.append((time.perf_counter() - start) * 1000)
+    pts0, pts1 = main.inlier_matches(mkpts0, mkpts1)
+    H = cv2.findHomography(pts0, pts1, cv2.RANSAC, 5.0)[0] if len(pts0) >= 4 else None
+    results.append({"inliers": len(pts0), "H": H, "ms": statistics.median(timings)})
+  return results
+
+
+def run():
+  args = parse_args()
+  queries = sorted(os.listdir(args.queries))[:args.limit or None]
+  topos = main.findFolderImages(f"./images/{main.regionNameToPath(args.region)}")
+  pairs = []
+  for filename in queries:
+    with open(os.path.join(args.queries, filename), "rb") as f:
+      query = main.get_tensor_image(f.read())
+    pairs.extend((query, main.reference_cache.get(topo["path"])) for topo in topos)
+  print(f"{len(pairs)} pairs ({len(queries)} queries x {len(topos)} topos of {args.region}) on {main.device}")
+
+  by_backend = {}
+  for backend in ["eager"] + [backend for backend in args.backends if backend != "eager"]:
+    try:
+      main.matcher, main.matcher_backend = main.build_matcher(backend), backend
+      by_backend[backend] = evaluate(pairs, args.repeat)
+    except Exception as e:
+      print(f"{backend}: unavailable ({e})")
+
+  if "eager" not in by_backend:
+    sys.exit("the eager baseline failed, nothing to compare against")
+  baseline = by_backend["eager"]
+  print(f"{'backend':8} {'p50 ms':>8} {'speedup':>8} {'inliers':>8} {'Δinliers':>9} {'corner px':>10} {'H failed':>9}")
+  for backend, results in by_backend.items():
+    latency = statistics.median(result["ms"] for result in results)
+    inlier_deltas = [abs(result["inliers"] - base["inliers"]) / max(base["inliers"], 1)
+                     for result, base in zip(results, baseline)]
+    shifts = [corner_shift(result["H"], base["H"], query["w"], query["h"])
+              for result, base, (query, _) in zip(results, baseline, pairs)
+              if result["H"] is not None and base["H"] is not None]
+    failed = sum(1 for result, base in zip(results, baseline) if (result["H"] is None) != (base["H"] is None))
+    print(f"{backend:8} {latency:8.1f} {statistics.median(r['ms'] for r in baseline) / latency:7.2f}x "
+          f"{statistics.median(result['inliers'] for result in results):8.0f} {statistics.mean(inlier_deltas):8.1%} "
+          f"{statistics.median(shifts) if shifts else float('nan'):10.1f} {failed:9}")
+
+
+if __name__ == "__main__":
+  run()
@@ -0,0 +1,68 @@
+# Compares the old get_tensor_image (full decode, float RGB, grayscale later)
+# with the reduced-scale grayscale ingest on the photos in test-user-images.
+# run from the repository root: python -m benchmarks.ingest
+import argparse
+import os
+import statistics
+import time
+
+import cv2
+import kornia as K
+import numpy as np
+
+from main import get_tensor_image, device
+
+
+def legacy_get_tensor_image(img_bytes, size=840):
+  img = np.asarray(bytearray(img_bytes), dtype="uint8")
+  img = cv2.imdecode(img, cv2.IMREAD_COLOR)
+  original_h, original_w = img.shape[0], img.shape[1]
+  scale = size / max(original_w, original_h)
+  w = int(img.shape[1] * scale)
+  h = int(img.shape[0] * scale)
+  img = cv2.resize(img, (w, h))
+  img = K.image_to_tensor(img, False).float() / 255.
+  img = K.color.bgr_to_rgb(img).to(device)
+  return {"gray": K.color.rgb_to_grayscale(img), "w": w, "h": h}
+
+
+def time_ms(fn, img_bytes, repeat):
+  timings = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn(img_bytes)
+    timings.append((time.perf_counter() - start) * 1000)
+  return statistics.median(timings)
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--folder", default="./test-user-images")
+  parser.add_argument("--size", type=int, default=840)
+  parser.add_argument("--repeat", type=int, default=5)
+  args = parser.parse_args()
+
+  total_legacy = total_fast = 0
+  print(f"{'image':45} {'legacy ms':>10} {'fast ms':>10} {'speedup':>8} {'gray diff':>10}")
+  for filename in sorted(os.listdir(args.folder)):
+    with open(os.path.join(args.folder, filename), "rb") as f:
+      img_bytes = f.read()
+
+    legacy_ms = time_ms(lambda b: legacy_get_tensor_image(b, args.size), img_bytes, args.repeat)
+    fast_ms = time_ms(lambda b: get_tensor_image(b, args.size), img_bytes, args.repeat)
+    total_legacy += legacy_ms
+    total_fast += fast_ms
+
+    # mean absolute pixel difference, only meaningful when both agree on the shape
+    legacy, fast = legacy_get_tensor_image(img_bytes, args.size), get_tensor_image(img_bytes, args.size)
+    if legacy["gray"].shape == fast["gray"].shape:
+      diff = f"{(legacy['gray'] - fast['gray']).abs().mean().item():.4f}"
+    else:
+      diff = "n/a"
+    print(f"{filename[:45]:45} {legacy_ms:10.1f} {fast_ms:10.1f} {legacy_ms / fast_ms:7.2f}x {diff:>10}")
+
+  print(f"{'total':45} {total_legacy:10.1f} {total_fast:10.1f} {total_legacy / total_fast:7.2f}x")
+
+
+if __name__ == "__main__":
+  main()
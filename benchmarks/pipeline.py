@@ -0,0 +1,188 @@
+# Replays test-user-images against the regions in images/ and times every
+# stage of the matching pipeline separately, then end to end through the API.
+# Runs on CPU unless --device cuda is given. Results are written as JSON and,
+# with --baseline, compared against an earlier run to flag regressions.
+# run from the repository root: python -m benchmarks.pipeline --regions stokowka
+import argparse
+import base64
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def parse_args():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--queries", default="./test-user-images")
+  parser.add_argument("--regions", nargs="*", help="region names as used by the API, e.g. margalef_espadelles (default: all)")
+  parser.add_argument("--limit", type=int, default=0, help="only use the first N query images")
+  parser.add_argument("--device", choices=["cpu", "cuda"], default="cpu")
+  parser.add_argument("--concurrency", type=int, nargs="*", default=[1, 4])
+  parser.add_argument("--requests", type=int, default=8, help="requests per concurrency level")
+  parser.add_argument("--output", default="benchmark_results.json")
+  parser.add_argument("--baseline", help="earlier results file to compare against")
+  parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative slowdown before flagging")
+  return parser.parse_args()
+
+
+args = parse_args()
+if args.device == "cpu":
+  os.environ["CUDA_VISIBLE_DEVICES"] = ""
+# every request should pay the full matching cost
+os.environ["RESULT_CACHE_SIZE"] = "0"
+os.environ.pop("RESULT_CACHE_DIR", None)
+
+import numpy as np
+from fastapi.testclient import TestClient
+
+import main
+
+
+def percentiles(timings):
+  return {
+    "count": len(timings),
+    "p50_ms": float(np.percentile(timings, 50)) if timings else None,
+    "p95_ms": float(np.percentile(timings, 95)) if timings else None,
+  }
+
+
+def timed(timings, stage, fn, *fn_args):
+  start = time.perf_counter()
+  result = fn(*fn_args)
+  timings.setdefault(stage, []).append((time.perf_counter() - start) * 1000)
+  return result
+
+
+def list_regions():
+  regions = []
+  for root, dirs, files in os.walk("./images"):
+    if any(filename.endswith(".jpg") for filename in files):
+      regions.append(os.path.relpath(root, "./images").replace(os.sep, "_"))
+  return sorted(regions)
+
+
+def list_queries():
+  queries = sorted(os.path.join(args.queries, filename) for filename in os.listdir(args.queries))
+  return queries[:args.limit] if args.limit else queries
+
+
+def bench_stages(queries, regions):
+  timings = {}
+  for query_path in queries:
+    with open(query_path, "rb") as f:
+      query = timed(timings, "decode", main.get_tensor_image, f.read())
+    for region in regions:
+      folder_path = f"./images/{main.regionNameToPath(region)}"
+      for found in main.findFolderImages(folder_path):
+        with open(found["path"], "rb") as f:
+          reference = timed(timings, "decode", main.get_tensor_image, f.read())
+        mkpts0, mkpts1 = timed(timings, "loftr", main.match_image_pairs, [(query["gray"], reference["gray"])])[0]
+        pts0, pts1 = timed(timings, "fundamental", main.inlier_matches, mkpts0, mkpts1)
+        if len(pts0) < 4:
+          continue
+        timed(timings, "homography", main.homography_pair, pts0, pts1)
+        response = {"matched_points": main.compact_points(pts0, pts1)}
+        timed(timings, "serialization", main.encode_response, response, main.ResponseFormat.json)
+  return timings
+
+
+def bench_api(client, queries, regions):
+  payloads = []
+  for query_path in queries:
+    with open(query_path, "rb") as f:
+      image_data = base64.b64encode(f.read()).decode()
+    payloads.extend({"image_data": image_data, "folder_path": region} for region in regions)
+
+  failures = []
+
+  def post(payload):
+    start = time.perf_counter()
+    response = client.post("/find_matching_matrix", json=payload)
+    if response.status_code != 200:
+      failures.append(response.status_code)
+    return (time.perf_counter() - start) * 1000
+
+  end_to_end = [post(payload) for payload in payloads]
+  if failures:
+    print(f"{len(failures)} requests failed with status {sorted(set(failures))}")
+
+  throughput = {}
+  for concurrency in args.concurrency:
+    batch = [payloads[i % len(payloads)] for i in range(args.requests)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+      latencies = list(executor.map(post, batch))
+    elapsed = time.perf_counter() - start
+    throughput[str(concurrency)] = {
+      "requests_per_second": len(batch) / elapsed,
+      **percentiles(latencies),
+    }
+  return end_to_end, throughput
+
+
+def compare(results, baseline):
+  regressions = []
+  for stage, current in results["stages"].items():
+    previous = baseline.get("stages", {}).get(stage)
+    if not previous:
+      continue
+    for metric in ("p50_ms", "p95_ms"):
+      if previous.get(metric) and current.get(metric) and current[metric] > previous[metric] * (1 + args.tolerance):
+        regressions.append(f"{stage} {metric}: {previous[metric]:.1f} -> {current[metric]:.1f}")
+  for concurrency, current in results["throughput"].items():
+    previous = baseline.get("throughput", {}).get(concurrency)
+    if previous and current["requests_per_second"] < previous["requests_per_second"] * (1 - args.tolerance):
+      regressions.append(f"throughput@{concurrency}: {previous['requests_per_second']:.2f} -> "
+                         f"{current['requests_per_second']:.2f} req/s")
+  return regressions
+
+
+def run():
+  regions = args.regions or list_regions()
+  queries = list_queries()
+  print(f"{len(queries)} queries x {len(regions)} regions on {main.device}")
+
+  # keep model loading and first-call kernel selection out of the timings
+  main.warm_up()
+  timings = bench_stages(queries, regions)
+  with TestClient(main.app) as client:
+    end_to_end, throughput = bench_api(client, queries, regions)
+
+  results = {
+    "environment": {
+      "device": str(main.device),
+      "python": platform.python_version(),
+      "torch": main.torch.__version__,
+      "machine": platform.machine(),
+      "cpus": os.cpu_count(),
+    },
+    "stages": {stage: percentiles(values) for stage, values in timings.items()},
+    "throughput": throughput,
+    # ru_maxrss is reported in kilobytes on Linux
+    "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+  }
+  results["stages"]["find_matching_matrix"] = percentiles(end_to_end)
+
+  for stage, stats in results["stages"].items():
+    print(f"{stage:22} n={stats['count']:5} p50={stats['p50_ms'] or 0:9.1f}ms p95={stats['p95_ms'] or 0:9.1f}ms")
+  for concurrency, stats in throughput.items():
+    print(f"concurrency {concurrency:>3}: {stats['requests_per_second']:.2f} req/s")
+  print(f"peak RSS: {results['peak_rss_mb']:.0f} MB")
+
+  with open(args.output, "w") as f:
+    json.dump(results, f, indent=2)
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      regressions = compare(results, json.load(f))
+    for regression in regressions:
+      print(f"REGRESSION {regression}")
+    if regressions:
+      sys.exit(1)
+
+
+if __name__ == "__main__":
+  run()
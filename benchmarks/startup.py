@@ -0,0 +1,73 @@
+# Measures cold start in fresh processes:
+#   eager   import main and load the model right away, then the first request
+#           runs cold (how the service started before lazy loading)
+#   warmup  import main, run the startup hook (load + warmup) until /readyz
+#           answers 200, then the first request
+# run from the repository root: python -m benchmarks.startup --region stokowka
+import argparse
+import base64
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+def parse_args():
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--image", default="./test-user-images/zachodnia-pod-katem.jpg")
+  parser.add_argument("--region", default="stokowka")
+  parser.add_argument("--runs", type=int, default=3)
+  parser.add_argument("--child", choices=["eager", "warmup"], help=argparse.SUPPRESS)
+  return parser.parse_args()
+
+
+def child(args):
+  os.environ["RESULT_CACHE_SIZE"] = "0"
+  if args.child == "eager":
+    os.environ["WARMUP_SIZES"] = ""
+
+  start = time.perf_counter()
+  import main
+  timings = {"import_s": time.perf_counter() - start}
+
+  from fastapi.testclient import TestClient
+  if args.child == "eager":
+    main.load_matcher()
+  with TestClient(main.app) as client:
+    while client.get("/readyz").status_code != 200:
+      time.sleep(0.05)
+    timings["ready_s"] = time.perf_counter() - start
+
+    with open(args.image, "rb") as f:
+      payload = {"image_data": base64.b64encode(f.read()).decode(), "folder_path": args.region}
+    request_start = time.perf_counter()
+    client.post("/find_matching_matrix", json=payload)
+    timings["first_request_s"] = time.perf_counter() - request_start
+    request_start = time.perf_counter()
+    client.post("/find_matching_matrix", json=payload)
+    timings["second_request_s"] = time.perf_counter() - request_start
+
+  print(json.dumps(timings))
+
+
+def run(args):
+  results = {}
+  for mode in ("eager", "warmup"):
+    runs = []
+    for _ in range(args.runs):
+      output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.startup", "--child", mode, "--image", args.image, "--region", args.region],
+        check=True, capture_output=True, text=True).stdout
+      runs.append(json.loads(output.strip().splitlines()[-1]))
+    results[mode] = {key: sorted(run[key] for run in runs)[len(runs) // 2] for key in runs[0]}
+
+  print(f"{'median of ' + str(args.runs):14} {'import':>8} {'ready':>8} {'1st req':>8} {'2nd req':>8}")
+  for mode, timings in results.items():
+    print(f"{mode:14} {timings['import_s']:8.2f} {timings['ready_s']:8.2f} "
+          f"{timings['first_request_s']:8.2f} {timings['second_request_s']:8.2f}")
+
+
+if __name__ == "__main__":
+  args = parse_args()
+  child(args) if args.child else run(args)
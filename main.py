@@ -1,22 +1,92 @@
 from enum import Enum
+from collections import OrderedDict
+import asyncio
 import cv2
 import json
 import os
+import queue
+import threading
+import time
+import traceback
 import numpy as np
 import base64
+import glob
+import hashlib
+import io
+import shutil
+import struct
+import contextvars
+import copy
+import re
+import uuid
+from contextlib import contextmanager, nullcontext
 import torch
-import matplotlib.pyplot as plt
-import kornia as K
-import kornia.feature as KF 
-from kornia_moons.viz import draw_LAF_matches
-from fastapi import FastAPI, Form, UploadFile, File, Query
+from PIL import Image
+from fastapi import FastAPI, Form, UploadFile, File, Query, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
 from fastapi.encoders import jsonable_encoder
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
 from typing import List, Optional, Dict
-
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+
+# memory budget for preprocessed reference images kept between requests
+REFERENCE_CACHE_MB = int(os.environ.get("REFERENCE_CACHE_MB", "512"))
+# how many reference images are matched against the query in one forward pass
+MATCH_BATCH_SIZE = int(os.environ.get("MATCH_BATCH_SIZE", "4"))
+# per-region file holding the global descriptors used to shortlist candidates
+# (retrieval_index.<backend>.npz for backends other than eager)
+RETRIEVAL_INDEX_FILE = "retrieval_index.npz"
+# inference worker: pending requests before answering 503, seconds a request
+# may wait for its matches, and how long to wait for more requests to batch
+INFERENCE_QUEUE_SIZE = int(os.environ.get("INFERENCE_QUEUE_SIZE", "16"))
+INFERENCE_TIMEOUT = float(os.environ.get("INFERENCE_TIMEOUT", "120"))
+INFERENCE_BATCH_WAIT_MS = float(os.environ.get("INFERENCE_BATCH_WAIT_MS", "10"))
+# coarse-to-fine search: low resolution pass and its RANSAC budget, how many
+# leading candidates get promoted to full resolution, and the inlier ratio
+# over the runner-up that lets a stage decide the match on its own
+SEARCH_COARSE_SIZE = int(os.environ.get("SEARCH_COARSE_SIZE", "480"))
+SEARCH_COARSE_RANSAC_ITERS = int(os.environ.get("SEARCH_COARSE_RANSAC_ITERS", "1000"))
+SEARCH_PROMOTE = int(os.environ.get("SEARCH_PROMOTE", "3"))
+SEARCH_MARGIN = float(os.environ.get("SEARCH_MARGIN", "1.5"))
+# computed match responses kept in memory, and an optional directory that
+# keeps them across restarts
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", "256"))
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR")
+RESULT_CACHE_DISK_ENTRIES = int(os.environ.get("RESULT_CACHE_DISK_ENTRIES", "4096"))
+# rendered match previews kept in memory
+RENDER_CACHE_SIZE = int(os.environ.get("RENDER_CACHE_SIZE", "64"))
+# resolutions reference backbone features are precomputed at when a crag is added
+PRECOMPUTE_SIZES = [int(size) for size in os.environ.get("PRECOMPUTE_SIZES", "840").split(",") if size]
+# how LoFTR runs: eager fp32, torch.compile'd backbone and transformers,
+# int8 dynamically quantized linear (attention) layers on CPU, or bfloat16 autocast
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "eager")
+# how often each worker refreshes its gauges in PROMETHEUS_MULTIPROC_DIR, the
+# directory serve.py's workers share their metrics through
+METRICS_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "5"))
+# resolutions dummy matches are run at on startup so kernel selection and
+# allocator warmup happen before /readyz reports ready (empty disables it)
+WARMUP_SIZES = [int(size) for size in os.environ.get("WARMUP_SIZES", f"840,{SEARCH_COARSE_SIZE}").split(",") if size]
+# seconds between rescans of ./images for changes made outside the API
+# (0 disables the watcher, the write endpoints keep the catalog current)
+CATALOG_POLL_INTERVAL = float(os.environ.get("CATALOG_POLL_INTERVAL", "0"))
+# frame tracking: sessions kept, idle seconds before one is dropped, inliers a
+# tracked frame needs before falling back to a full region search, and the
+# resolution LoFTR re-verifies the tracked topo at. TRACKING_DIR is shared by
+# the workers of one server, set by serve.py when it forks (empty: sessions
+# stay in this process).
+TRACKING_DIR = os.environ.get("TRACKING_DIR") or None
+TRACKING_SESSIONS = int(os.environ.get("TRACKING_SESSIONS", "64"))
+TRACKING_SESSION_TTL = float(os.environ.get("TRACKING_SESSION_TTL", "300"))
+TRACKING_MIN_INLIERS = int(os.environ.get("TRACKING_MIN_INLIERS", "40"))
+TRACKING_SIZE = int(os.environ.get("TRACKING_SIZE", str(SEARCH_COARSE_SIZE)))
+# session ids are file names in TRACKING_DIR
+TRACKING_SESSION_ID = re.compile(r"[A-Za-z0-9_-]{1,64}")
+# inliers a topo needs to be returned as an overlap of the query
+OVERLAP_MIN_INLIERS = int(os.environ.get("OVERLAP_MIN_INLIERS", "50"))
 
 #setting up device
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -24,7 +94,6 @@ print(f"Using device: {device}")
 
 #initializing api insance
 app = FastAPI()
-print("API is ready to use")
 
 # Add CORS middleware
 app.add_middleware(
@@ -33,8 +102,127 @@ app.add_middleware(
   allow_credentials=True,
   allow_methods=["*"],
   allow_headers=["*"],
+  expose_headers=["Server-Timing", "ETag"],
 )
 
+# Prometheus metrics through prometheus_client, each created on first use
+# from the name and label names of the call. Under serve.py every worker
+# writes its values to PROMETHEUS_MULTIPROC_DIR and /metrics merges the files
+# of all of them. Gauges, and counters for totals kept elsewhere, are read
+# from callbacks on every scrape and every METRICS_FLUSH_INTERVAL seconds, so
+# each live worker reports its own.
+class Metrics:
+  SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+  COUNTS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+  RATIOS = (0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1)
+
+  def __init__(self, prefix, registry=REGISTRY):
+    self.prefix = prefix
+    self.registry = registry
+    self.metrics = {}
+    self.gauge_fns = {}
+    self.counter_fns = {}
+    # last value of every counter callback sample, to add only what it grew by
+    self.published = {}
+    self.lock = threading.Lock()
+
+  def metric(self, kind, name, labels, **kwargs):
+    labels = labels or {}
+    with self.lock:
+      if name not in self.metrics:
+        self.metrics[name] = kind(f"{self.prefix}{name}", name.replace("_", " "), sorted(labels),
+                                  registry=self.registry, **kwargs)
+      metric = self.metrics[name]
+    return metric.labels(**labels) if labels else metric
+
+  def inc(self, name, labels=None, value=1):
+    self.metric(Counter, name, labels).inc(value)
+
+  def observe(self, name, value, labels=None, buckets=SECONDS):
+    self.metric(Histogram, name, labels, buckets=buckets).observe(value)
+
+  # fn returns a number, or a list of (labels, number)
+  def gauge(self, name, fn):
+    self.gauge_fns[name] = fn
+
+  # same as gauge, for totals that only ever grow
+  def counter(self, name, fn):
+    self.counter_fns[name] = fn
+
+  @staticmethod
+  def samples(fn):
+    value = fn()
+    return value if isinstance(value, list) else [({}, value)]
+
+  def refresh(self):
+    for name, fn in self.gauge_fns.items():
+      for labels, value in self.samples(fn):
+        self.metric(Gauge, name, labels, multiprocess_mode="liveall").set(value)
+    for name, fn in self.counter_fns.items():
+      for labels, value in self.samples(fn):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+          grown = value - self.published.get(key, 0)
+          self.published[key] = value
+        counter = self.metric(Counter, name, labels)
+        if grown > 0:
+          counter.inc(grown)
+
+  # keeps this worker's gauges current for scrapes served by other workers
+  def refresh_periodically(self, interval):
+    while True:
+      time.sleep(interval)
+      self.refresh()
+
+  def render(self):
+    self.refresh()
+    if not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+      return generate_latest(self.registry)
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+metrics = Metrics("topomatch_")
+
+# stage -> [total seconds, calls] for the current request when profiling is on
+request_profile = contextvars.ContextVar("request_profile", default=None)
+
+# Times a pipeline stage into the stage histogram and, for profiled requests,
+# into the per-request breakdown returned in the Server-Timing header
+@contextmanager
+def span(stage):
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    elapsed = time.perf_counter() - start
+    metrics.observe("stage_duration_seconds", elapsed, {"stage": stage})
+    profile = request_profile.get()
+    if profile is not None:
+      total, calls = profile.get(stage, (0.0, 0))
+      profile[stage] = (total + elapsed, calls + 1)
+
+# Route latency for every request. Sending `X-Profile: 1` returns the
+# request's stage timings as a Server-Timing header.
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+  profile = {} if request.headers.get("x-profile") == "1" else None
+  token = request_profile.set(profile)
+  start = time.perf_counter()
+  try:
+    response = await call_next(request)
+  finally:
+    request_profile.reset(token)
+  elapsed = time.perf_counter() - start
+  route = request.scope.get("route")
+  labels = {"route": route.path if route is not None else "unmatched", "method": request.method}
+  metrics.observe("request_duration_seconds", elapsed, labels)
+  metrics.inc("requests_total", dict(labels, status=response.status_code))
+  if profile is not None:
+    stages = [f"{stage};dur={total * 1000:.1f};desc=\"{calls} calls\"" for stage, (total, calls) in profile.items()]
+    response.headers["Server-Timing"] = ", ".join(stages + [f"total;dur={elapsed * 1000:.1f}"])
+  return response
+
 # this could help with warping
 # https://huggingface.co/spaces/Realcat/image-matching-webui
 # https://github.com/Vincentqyw/image-matching-webui
@@ -43,9 +231,60 @@ app.add_middleware(
 # https://github.com/Eric-Canas/Homography.js - this might be awesome - it's on the frontend!
 
 #Load model
-matcher = KF.LoFTR(pretrained=None)
-matcher.load_state_dict(torch.load("./models/loftr_outdoor.ckpt")['state_dict'])
-matcher = matcher.to(device).eval()
+# LoFTR (and kornia with it) is only imported and loaded on first use, so
+# importing this module stays cheap; the startup hook loads and warms it up.
+matcher = None
+matcher_backend = INFERENCE_BACKEND
+matcher_lock = threading.Lock()
+model_ready = threading.Event()
+
+def build_matcher(backend=INFERENCE_BACKEND):
+  import kornia.feature as KF
+  model = KF.LoFTR(pretrained=None)
+  model.load_state_dict(torch.load("./models/loftr_outdoor.ckpt")['state_dict'])
+  model = model.to(device).eval()
+
+  if backend == "compile":
+    # shapes vary with the image aspect ratio and the number of coarse matches
+    for name in ("backbone", "loftr_coarse", "loftr_fine"):
+      setattr(model, name, torch.compile(getattr(model, name), dynamic=True))
+  elif backend == "int8":
+    if device.type != "cpu":
+      raise ValueError("the int8 backend only runs on CPU")
+    model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+  elif backend not in ("eager", "bf16"):
+    raise ValueError(f"unknown INFERENCE_BACKEND {backend!r}, expected eager, compile, int8 or bf16")
+  return model
+
+def load_matcher():
+  global matcher
+  with matcher_lock:
+    if matcher is None:
+      matcher = build_matcher(matcher_backend)
+      print(f"Loaded LoFTR with the {matcher_backend} backend on {device}")
+  return matcher
+
+def inference_context():
+  if matcher_backend == "bf16":
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+  return nullcontext()
+
+# Runs a textured dummy image against a shifted copy of itself at every
+# warmup size, for single pairs and full batches, then marks the model ready
+def warm_up():
+  load_matcher()
+  rng = np.random.default_rng(0)
+  for size in WARMUP_SIZES:
+    h, w = size * 3 // 4, size
+    texture = cv2.GaussianBlur(rng.integers(0, 255, (h, w + 32), dtype=np.uint8), (7, 7), 0)
+    image0 = image_to_tensor(texture[:, :w]).float().div(255.).to(device)
+    image1 = image_to_tensor(texture[:, 32:]).float().div(255.).to(device)
+    start = time.perf_counter()
+    match_image_pairs([(image0, image1)])
+    match_image_pairs([(image0, image1)] * MATCH_BATCH_SIZE)
+    print(f"Warmed up at {w}x{h} in {time.perf_counter() - start:.2f}s")
+  model_ready.set()
+  print("API is ready to use")
 
 class RegionData(BaseModel):
   region_name: str
@@ -58,81 +297,806 @@ async def validation_exception_handler(request, exc):
         content=jsonable_encoder({"detail": exc.errors(), "body": exc.body}),
     )
 
+# EXIF orientations that swap width and height once applied
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+# Size of the image as displayed, i.e. after EXIF orientation, read from the
+# header only. JPEGs report whether they can be decoded at a reduced scale.
+# source is a path or a file object, anything Image.open accepts.
+def read_image_header(source):
+  with Image.open(source) as header:
+    original_w, original_h = header.size
+    orientation = header.getexif().get(0x0112, 1)
+    is_jpeg = header.format == "JPEG"
+  if orientation in TRANSPOSED_ORIENTATIONS:
+    original_w, original_h = original_h, original_w
+  return original_w, original_h, is_jpeg
+
+# Largest libjpeg DCT scaling (1/2, 1/4, 1/8) that still leaves at least
+# `size` pixels on the long side, so the resize after it only ever shrinks
+def decode_flags(original_w, original_h, size, is_jpeg, color):
+  if is_jpeg:
+    for factor in (8, 4, 2):
+      if max(original_w, original_h) // factor >= size:
+        return getattr(cv2, f"IMREAD_REDUCED_{'COLOR' if color else 'GRAYSCALE'}_{factor}")
+  return cv2.IMREAD_COLOR if color else cv2.IMREAD_GRAYSCALE
+
+# HxW or HxWxC uint8 array to a 1xCxHxW tensor
+def image_to_tensor(img):
+  tensor = torch.from_numpy(np.ascontiguousarray(img))
+  return tensor[None, None] if tensor.ndim == 2 else tensor.permute(2, 0, 1)[None]
+
 #bytes-image to tensor
-def get_tensor_image(img_bytes):
-  img = np.asarray(bytearray(img_bytes), dtype="uint8")
-  img = cv2.imdecode(img, cv2.IMREAD_COLOR)
-  original_h, original_w = img.shape[0], img.shape[1]
-  print(f"Original image size: {original_w}x{original_h}")
-  scale = 840 / max(original_w, original_h) 
-  w = int(img.shape[1] * scale)
-  h = int(img.shape[0] * scale)
-  img = cv2.resize(img, (w, h))
-  img = K.image_to_tensor(img, False).float() /255.
-  img = K.color.bgr_to_rgb(img)
-  return {"img": img.to(device), "w": w, "h": h, "original_w": original_w, "original_h": original_h}
-
-async def process_matching(img1, img2):
-  input_dict = {"image0": K.color.rgb_to_grayscale(img1),
-    "image1": K.color.rgb_to_grayscale(img2)}
+# Decodes straight to the working resolution (EXIF orientation applied by
+# OpenCV) and builds the grayscale tensor the matcher needs. The RGB tensor is
+# only produced with color=True, for visualizations.
+def get_tensor_image(img_bytes, size=840, color=False):
+  with span("decode"):
+    original_w, original_h, is_jpeg = read_image_header(io.BytesIO(img_bytes))
+    buffer = np.frombuffer(img_bytes, dtype=np.uint8)
+    img = cv2.imdecode(buffer, decode_flags(original_w, original_h, size, is_jpeg, color))
+    scale = size / max(original_w, original_h)
+    w = int(original_w * scale)
+    h = int(original_h * scale)
+    img = cv2.resize(img, (w, h))
+  metrics.observe("image_megapixels", original_w * original_h / 1e6, buckets=(0.5, 1, 2, 4, 8, 12, 16, 24, 48))
+
+  tensor = {"w": w, "h": h, "original_w": original_w, "original_h": original_h}
+  if color:
+    tensor["img"] = (image_to_tensor(cv2.cvtColor(img, cv2.COLOR_BGR2RGB)).float() / 255.).to(device)
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+  tensor["gray"] = (image_to_tensor(img).float() / 255.).to(device)
+  return tensor
+
+# Opens a uniquely named temporary file next to path and renames it over path
+# once the block completes, so writers in other threads or worker processes
+# neither clobber each other's temporary file nor expose a partial file
+@contextmanager
+def atomic_write(path, mode="wb"):
+  directory, name = os.path.split(path)
+  tmp_path = os.path.join(directory, f".{name}.{os.getpid()}.{uuid.uuid4().hex}.tmp")
+  try:
+    with open(tmp_path, mode) as f:
+      yield f
+    os.replace(tmp_path, path)
+  except BaseException:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+    raise
+
+# Preprocessed reference images (grayscale tensor + size metadata) keyed by path
+# and target size. Entries are dropped when the file's mtime changes or the
+# memory budget is exceeded.
+class ReferenceCache:
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.entries = OrderedDict()
+    self.total_bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+  def get(self, path, size=840):
+    key = (os.path.normpath(path), size)
+    mtime = os.stat(path).st_mtime_ns
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None and entry["mtime"] == mtime:
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+      self.misses += 1
+
+    with open(path, "rb") as f:
+      tensor = get_tensor_image(f.read(), size)
+    gray = tensor["gray"]
+    entry = {
+      "gray": gray,
+      "w": tensor["w"],
+      "h": tensor["h"],
+      "original_w": tensor["original_w"],
+      "original_h": tensor["original_h"],
+      "mtime": mtime,
+      "nbytes": gray.element_size() * gray.nelement(),
+    }
+    with self.lock:
+      self._remove(key)
+      self.entries[key] = entry
+      self.total_bytes += entry["nbytes"]
+      while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+        _, evicted = self.entries.popitem(last=False)
+        self.total_bytes -= evicted["nbytes"]
+    return entry
+
+  def invalidate(self, path):
+    path = os.path.normpath(path)
+    with self.lock:
+      for key in [key for key in self.entries if key[0] == path]:
+        self._remove(key)
+
+  def _remove(self, key):
+    entry = self.entries.pop(key, None)
+    if entry is not None:
+      self.total_bytes -= entry["nbytes"]
+
+reference_cache = ReferenceCache(REFERENCE_CACHE_MB * 1024 * 1024)
+
+# Computed match responses keyed by a hash of the query bytes and everything
+# the result depends on (region, reference mtimes, search parameters).
+# In-memory LRU in front of an optional on-disk tier; entries are grouped by
+# region so writes to a region can drop them. The disk tier is capped at
+# max_disk_entries files, pruned least recently used first by mtime (reads
+# touch the file), down to 90% of the cap so pruning doesn't run on every put.
+# With a directory get, put and invalidate_region hit the disk, so handlers
+# call them through run_in_threadpool.
+class ResultCache:
+  def __init__(self, max_entries, directory=None, max_disk_entries=RESULT_CACHE_DISK_ENTRIES):
+    self.max_entries = max_entries
+    self.directory = directory
+    self.max_disk_entries = max_disk_entries
+    # files written since the directory was last counted, None until then
+    self.disk_entries = None
+    self.entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.lock = threading.Lock()
+
+  # the inference backend is part of every key: eager, int8 and bf16 don't
+  # produce the same matches
+  @staticmethod
+  def key(*parts):
+    digest = hashlib.sha256(matcher_backend.encode())
+    for part in parts:
+      digest.update(part if isinstance(part, bytes) else json.dumps(part, sort_keys=True).encode())
+    return digest.hexdigest()
+
+  @staticmethod
+  def region_tag(folder_path):
+    return hashlib.sha1(os.path.normpath(folder_path).encode()).hexdigest()[:16] if folder_path else "pairs"
+
+  def disk_path(self, region, key):
+    return os.path.join(self.directory, region, f"{key}.json")
+
+  def get(self, key, folder_path=None):
+    region = self.region_tag(folder_path)
+    with self.lock:
+      if (region, key) in self.entries:
+        self.entries.move_to_end((region, key))
+        self.hits += 1
+        return self.entries[(region, key)]
+
+    if self.directory:
+      try:
+        with open(self.disk_path(region, key)) as f:
+          value = json.load(f)
+        os.utime(self.disk_path(region, key))
+      except (FileNotFoundError, json.JSONDecodeError):
+        value = None
+      if value is not None:
+        with self.lock:
+          self.hits += 1
+        self.remember(region, key, value)
+        return value
+
+    with self.lock:
+      self.misses += 1
+    return None
+
+  def put(self, key, value, folder_path=None):
+    region = self.region_tag(folder_path)
+    self.remember(region, key, value)
+    if self.directory:
+      path = self.disk_path(region, key)
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      with atomic_write(path, "w") as f:
+        json.dump(value, f)
+      with self.lock:
+        prune = self.disk_entries is None or self.disk_entries >= self.max_disk_entries
+        if not prune:
+          self.disk_entries += 1
+      if prune:
+        self.prune()
+
+  # other workers share the directory, so the count is taken from the disk
+  def prune(self):
+    files = []
+    for root, dirs, filenames in os.walk(self.directory):
+      for filename in filenames:
+        if filename.endswith(".json"):
+          path = os.path.join(root, filename)
+          try:
+            files.append((os.stat(path).st_mtime_ns, path))
+          except FileNotFoundError:
+            pass
+    excess = len(files) - int(self.max_disk_entries * 0.9) if len(files) > self.max_disk_entries else 0
+    for _, path in sorted(files)[:excess]:
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+    with self.lock:
+      self.disk_entries = len(files) - excess
+
+  def remember(self, region, key, value):
+    with self.lock:
+      self.entries[(region, key)] = value
+      self.entries.move_to_end((region, key))
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+
+  def invalidate_region(self, folder_path):
+    region = self.region_tag(folder_path)
+    with self.lock:
+      for entry_key in [entry_key for entry_key in self.entries if entry_key[0] == region]:
+        del self.entries[entry_key]
+    if self.directory:
+      shutil.rmtree(os.path.join(self.directory, region), ignore_errors=True)
+
+  def stats(self):
+    with self.lock:
+      lookups = self.hits + self.misses
+      return {
+        "hits": self.hits,
+        "misses": self.misses,
+        "hit_rate": self.hits / lookups if lookups else 0.0,
+        "entries": len(self.entries),
+      }
 
-  with torch.no_grad():
-    correspondences = matcher(input_dict)
-
-  mkpts0 = correspondences['keypoints0'].cpu().numpy()
-  mkpts1 = correspondences['keypoints1'].cpu().numpy()
-  _, inliers = cv2.findFundamentalMat(mkpts0, mkpts1, cv2.USAC_MAGSAC, 0.5, 0.999999, 10000)
-  inliers = (inliers > 0).flatten()
-
-  # Generate a colormap for the lines
-  colormap = plt.cm.get_cmap('hsv', len(inliers))
-
-  fig, ax = draw_LAF_matches(
-      KF.laf_from_center_scale_ori(torch.from_numpy(mkpts0).view(1, -1, 2),
-                                   torch.ones(mkpts0.shape[0]).view(1, -1, 1, 1),
-                                   torch.ones(mkpts0.shape[0]).view(1, -1, 1)),
-      KF.laf_from_center_scale_ori(torch.from_numpy(mkpts1).view(1, -1, 2),
-                                   torch.ones(mkpts1.shape[0]).view(1, -1, 1, 1),
-                                   torch.ones(mkpts1.shape[0]).view(1, -1, 1)),
-      torch.arange(mkpts0.shape[0]).view(-1, 1).repeat(1, 2),
-      K.tensor_to_image(img1),
-      K.tensor_to_image(img2),
-      inliers,
-      draw_dict={'inlier_color': None,  # Disable default inlier color
-                 'tentative_color': None,
-                 'feature_color': (0.2, 0.5, 1), 'vertical': False}, return_fig_ax=True)
-
-  # Draw lines with varying colors
-  for i, (pt0, pt1) in enumerate(zip(mkpts0[inliers], mkpts1[inliers])):
-      color = colormap(i / len(inliers))[:3]  # Get RGB color from colormap
-      ax.plot([pt0[0], pt1[0] + img1.shape[3]], [pt0[1], pt1[1]], color=color)
-
-  ax.axis('off')
-  plt.savefig('output.jpg', bbox_inches='tight')
-  return FileResponse("./output.jpg", media_type="image/jpeg")
-
-
-async def getMatchingMatrix(img1, img2):
-  input_dict = {"image0": K.color.rgb_to_grayscale(img1),
-    "image1": K.color.rgb_to_grayscale(img2)}
+result_cache = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_DIR)
 
-  with torch.no_grad():
-    correspondences = matcher(input_dict)
+# (name, image mtime, json mtime) for every topo of a region, so a cached
+# result goes stale as soon as any reference image or crag JSON changes
+def region_signature(compare_images):
+  signature = []
+  for img in compare_images:
+    base, _ = os.path.splitext(img)
+    json_mtime = os.stat(f"{base}.json").st_mtime_ns if os.path.exists(f"{base}.json") else 0
+    signature.append([img, os.stat(img).st_mtime_ns, json_mtime])
+  return signature
+
+render_cache = ResultCache(RENDER_CACHE_SIZE)
+
+# Reference backbone features stored next to the topo as float16 .npy files
+# (<name>.loftr<size>.coarse.npy / .fine.npy, plus .hw.npy with the size of
+# the image the backbone saw; loftr<size>-<backend> for backends other than
+# eager, whose backbone output differs). They are returned as memory-mapped float16
+# arrays and only turned into fp32 tensors batch by batch on the inference
+# thread (see feature_tensor), so loading a region's candidates copies nothing.
+# Files older than their image are ignored.
+class FeatureStore:
+  def paths(self, image_path, size):
+    base, _ = os.path.splitext(image_path)
+    prefix = f"{base}.loftr{size}" if matcher_backend == "eager" else f"{base}.loftr{size}-{matcher_backend}"
+    return f"{prefix}.coarse.npy", f"{prefix}.fine.npy", f"{prefix}.hw.npy"
+
+  def load(self, image_path, size=840):
+    paths = self.paths(image_path, size)
+    try:
+      image_mtime = os.stat(image_path).st_mtime_ns
+      if min(os.stat(path).st_mtime_ns for path in paths) < image_mtime:
+        return None
+      # copy-on-write maps are writable, so torch.from_numpy takes them without a copy or a warning
+      coarse = np.load(paths[0], mmap_mode="c")
+      fine = np.load(paths[1], mmap_mode="c")
+      hw = tuple(int(side) for side in np.load(paths[2]))
+    except (FileNotFoundError, ValueError):
+      return None
+    return {"coarse": coarse, "fine": fine, "hw": hw}
+
+  def precompute(self, image_path, size=840):
+    features = extract_features(reference_cache.get(image_path, size)["gray"])
+    arrays = (features["coarse"].cpu().numpy().astype(np.float16),
+              features["fine"].cpu().numpy().astype(np.float16),
+              np.array(features["hw"], dtype=np.int64))
+    for path, array in zip(self.paths(image_path, size), arrays):
+      with atomic_write(path) as f:
+        np.save(f, array)
+
+  # every size and backend
+  def remove(self, image_path):
+    base, _ = os.path.splitext(image_path)
+    for path in glob.glob(f"{glob.escape(base)}.loftr*.npy"):
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+
+feature_store = FeatureStore()
+
+# what a reference contributes to a match pair: its stored backbone features
+# when they are up to date, otherwise the grayscale tensor
+def reference_input(image_path, size=840):
+  features = feature_store.load(image_path, size)
+  return features if features is not None else reference_cache.get(image_path, size)["gray"]
+
+# lines are grouped into this many hue bands so each band is one polylines call
+RENDER_HUE_BANDS = 24
+
+def to_bgr_image(img):
+  rgb = (img[0].permute(1, 2, 0).cpu().numpy() * 255).astype(np.uint8)
+  return cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+
+# Side by side JPEG of both images with every keypoint and the inlier matches
+# drawn in hues cycling along the match list. The output is scaled so its
+# longest side is at most max_size (0 keeps the working resolution).
+def render_matching(img1, img2, mkpts0, mkpts1, max_size=0, quality=90):
+  inliers = get_inliers(mkpts0, mkpts1)
+  left, right = to_bgr_image(img1), to_bgr_image(img2)
+  width = left.shape[1] + right.shape[1]
+  height = max(left.shape[0], right.shape[0])
+  scale = min(1.0, max_size / max(width, height)) if max_size else 1.0
+
+  canvas = np.zeros((int(height * scale), int(width * scale), 3), dtype=np.uint8)
+  left = cv2.resize(left, (int(left.shape[1] * scale), int(left.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+  right = cv2.resize(right, (canvas.shape[1] - left.shape[1], int(right.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+  canvas[:left.shape[0], :left.shape[1]] = left
+  canvas[:right.shape[0], left.shape[1]:] = right
+
+  pts0 = np.round(mkpts0 * scale).astype(np.int32)
+  pts1 = np.round(mkpts1 * scale + [left.shape[1], 0]).astype(np.int32)
+  feature_color = (255, 128, 51)
+  cv2.polylines(canvas, list(np.concatenate([pts0, pts1]).reshape(-1, 1, 2)), True, feature_color, 2)
+
+  segments = np.stack([pts0[inliers], pts1[inliers]], axis=1)
+  bands = np.arange(len(segments)) * RENDER_HUE_BANDS // max(len(segments), 1)
+  for band in range(RENDER_HUE_BANDS):
+    band_segments = segments[bands == band]
+    if len(band_segments):
+      hue = np.uint8([[[band * 180 // RENDER_HUE_BANDS, 255, 255]]])
+      color = tuple(int(c) for c in cv2.cvtColor(hue, cv2.COLOR_HSV2BGR)[0, 0])
+      cv2.polylines(canvas, list(band_segments), False, color, 1, cv2.LINE_AA)
+
+  _, encoded = cv2.imencode(".jpg", canvas, [cv2.IMWRITE_JPEG_QUALITY, quality])
+  return encoded.tobytes()
+
+# tensors from get_tensor_image(..., color=True)
+async def process_matching(tensor1, tensor2, max_size=0, quality=90):
+  mkpts0, mkpts1 = (await inference.match_pairs(tensor1['gray'], [tensor2['gray']]))[0]
+  return await run_in_threadpool(render_matching, tensor1['img'], tensor2['img'], mkpts0, mkpts1, max_size, quality)
+
+# LoFTR split in two: the ResNet-FPN backbone, whose output for a reference
+# image never changes and can be stored, and the transformers and matching
+# heads that run per pair. Features are {"coarse", "fine", "hw"} where hw is the
+# size of the image the backbone saw.
+def extract_features(gray):
+  model = load_matcher()
+  with torch.no_grad(), inference_context():
+    feat_c, feat_f = model.backbone(gray)
+  # stored and precomputed features are mixed in batches, keep them all fp32
+  return {"coarse": feat_c.float(), "fine": feat_f.float(), "hw": tuple(gray.shape[2:])}
+
+# Same steps as KF.LoFTR.forward after the backbone (no masks).
+# Returns keypoints0, keypoints1 and batch_indexes.
+def match_features(features0, features1):
+  feat_c0, feat_f0 = features0["coarse"], features0["fine"]
+  feat_c1, feat_f1 = features1["coarse"], features1["fine"]
+  data = {
+    "bs": feat_c0.size(0),
+    "hw0_i": torch.Size(features0["hw"]), "hw1_i": torch.Size(features1["hw"]),
+    "hw0_c": feat_c0.shape[2:], "hw1_c": feat_c1.shape[2:],
+    "hw0_f": feat_f0.shape[2:], "hw1_f": feat_f1.shape[2:],
+  }
+  matcher = load_matcher()
+  with torch.no_grad(), inference_context():
+    feat_c0 = matcher.pos_encoding(feat_c0).permute(0, 2, 3, 1)
+    feat_c0 = feat_c0.reshape(feat_c0.shape[0], -1, feat_c0.shape[3])
+    feat_c1 = matcher.pos_encoding(feat_c1).permute(0, 2, 3, 1)
+    feat_c1 = feat_c1.reshape(feat_c1.shape[0], -1, feat_c1.shape[3])
+    feat_c0, feat_c1 = matcher.loftr_coarse(feat_c0, feat_c1, None, None)
+
+    matcher.coarse_matching(feat_c0, feat_c1, data, mask_c0=None, mask_c1=None)
+
+    feat_f0_unfold, feat_f1_unfold = matcher.fine_preprocess(feat_f0, feat_f1, feat_c0, feat_c1, data)
+    if feat_f0_unfold.size(0) != 0:
+      feat_f0_unfold, feat_f1_unfold = matcher.loftr_fine(feat_f0_unfold, feat_f1_unfold)
+    matcher.fine_matching(feat_f0_unfold, feat_f1_unfold, data)
+  return data["mkpts0_f"], data["mkpts1_f"], data["b_ids"]
+
+# pair elements are grayscale tensors or precomputed features
+def input_size(item):
+  return item["hw"] if isinstance(item, dict) else tuple(item.shape[2:])
+
+# stored features are float16 arrays until a batch needs them
+def feature_tensor(feature):
+  if isinstance(feature, np.ndarray):
+    return torch.from_numpy(feature).to(device, dtype=torch.float32)
+  return feature
+
+def as_features(item):
+  if not isinstance(item, dict):
+    return extract_features(item)
+  return {"coarse": feature_tensor(item["coarse"]), "fine": feature_tensor(item["fine"]), "hw": item["hw"]}
+
+# Stacks the features of same-sized items, running the backbone once over
+# all the grayscale tensors among them. A batch that is one query repeated
+# (the usual image0 side) is expanded instead of copied.
+def batch_features(items):
+  if isinstance(items[0], dict) and all(item is items[0] for item in items):
+    return {
+      "coarse": feature_tensor(items[0]["coarse"]).expand(len(items), -1, -1, -1),
+      "fine": feature_tensor(items[0]["fine"]).expand(len(items), -1, -1, -1),
+      "hw": items[0]["hw"],
+    }
+  features = [item if isinstance(item, dict) else None for item in items]
+  grays = [i for i, item in enumerate(items) if features[i] is None]
+  if grays:
+    extracted = extract_features(torch.cat([items[i] for i in grays]))
+    for b, i in enumerate(grays):
+      features[i] = {"coarse": extracted["coarse"][b:b + 1], "fine": extracted["fine"][b:b + 1]}
+  return {
+    "coarse": torch.cat([feature_tensor(f["coarse"]) for f in features]),
+    "fine": torch.cat([feature_tensor(f["fine"]) for f in features]),
+    "hw": input_size(items[0]),
+  }
 
-  mkpts0 = correspondences['keypoints0'].cpu().numpy()
-  mkpts1 = correspondences['keypoints1'].cpu().numpy()
-  _, inliers = cv2.findFundamentalMat(mkpts0, mkpts1, cv2.USAC_MAGSAC, 0.5, 0.999999, 10000)
-  inliers = (inliers > 0).flatten()
+# Matches (image0, image1) pairs, each side a grayscale tensor or precomputed
+# features. Pairs are bucketed by their resized shapes so each bucket can be
+# stacked into batches of `batch_size` and sent through LoFTR together; the
+# correspondences are split back per pair using `batch_indexes`.
+# Returns a list of (mkpts0, mkpts1) in pair order.
+def match_image_pairs(pairs, batch_size=MATCH_BATCH_SIZE):
+  # a grayscale tensor used by several pairs (the query of a region search)
+  # goes through the backbone once and its features are shared by every pair
+  uses = {}
+  for pair in pairs:
+    for item in pair:
+      if not isinstance(item, dict):
+        uses[id(item)] = uses.get(id(item), 0) + 1
+  shared = {}
+
+  def resolve(item):
+    if isinstance(item, dict) or uses[id(item)] == 1:
+      return item
+    if id(item) not in shared:
+      shared[id(item)] = extract_features(item)
+    return shared[id(item)]
+
+  pairs = [(resolve(image0), resolve(image1)) for image0, image1 in pairs]
+
+  results = [None] * len(pairs)
+  buckets = {}
+  for i, (image0, image1) in enumerate(pairs):
+    buckets.setdefault((input_size(image0), input_size(image1)), []).append(i)
+
+  for indexes in buckets.values():
+    for start in range(0, len(indexes), batch_size):
+      chunk = indexes[start:start + batch_size]
+      keypoints0, keypoints1, batch_indexes = match_features(
+        batch_features([pairs[i][0] for i in chunk]),
+        batch_features([pairs[i][1] for i in chunk]))
+
+      mkpts0 = keypoints0.float().cpu().numpy()
+      mkpts1 = keypoints1.float().cpu().numpy()
+      batch_indexes = batch_indexes.cpu().numpy()
+      for b, i in enumerate(chunk):
+        selected = batch_indexes == b
+        results[i] = (mkpts0[selected], mkpts1[selected])
+
+  return results
+
+def get_inliers(mkpts0, mkpts1, max_iters=10000):
+  # the fundamental matrix needs at least 8 correspondences
+  if len(mkpts0) < 8:
+    return np.zeros(len(mkpts0), dtype=bool)
+  with span("ransac"):
+    _, inliers = cv2.findFundamentalMat(mkpts0, mkpts1, cv2.USAC_MAGSAC, 0.5, 0.999999, max_iters)
+  if inliers is None:
+    return np.zeros(len(mkpts0), dtype=bool)
+  return (inliers > 0).flatten()
+
+# inlier correspondences as two (N, 2) float32 arrays
+def inlier_matches(mkpts0, mkpts1, max_iters=10000):
+  inliers = get_inliers(mkpts0, mkpts1, max_iters)
+  metrics.observe("loftr_matches", len(mkpts0), buckets=Metrics.COUNTS)
+  if len(mkpts0):
+    metrics.observe("inlier_ratio", inliers.sum() / len(mkpts0), buckets=Metrics.RATIOS)
+  return mkpts0[inliers], mkpts1[inliers]
+
+async def getMatchingMatrix(gray1, gray2):
+  mkpts0, mkpts1 = (await inference.match_pairs(gray1, [gray2]))[0]
+  return await run_in_threadpool(inlier_matches, mkpts0, mkpts1)
+
+# homography from query to reference points and its inverse, both flattened.
+# LinAlgError when RANSAC finds none or it isn't invertible.
+def homography_pair(pts0, pts1):
+  with span("homography"):
+    H, _ = cv2.findHomography(pts0, pts1, cv2.RANSAC, 5.0)
+  if H is None:
+    raise np.linalg.LinAlgError("No homography fits the matches")
+  return H.flatten().tolist(), np.linalg.inv(H).flatten().tolist()
+
+# Map the points in the path property of each crag from the original topo
+# resolution to the resolution it was matched at
+def scale_crag_paths(json_content, tensor):
+  if not json_content or "crags" not in json_content:
+    return json_content
+  scale = np.array([tensor['w'] / tensor['original_w'], tensor['h'] / tensor['original_h']])
+  for crag in json_content["crags"]:
+    if crag.get("path"):
+      crag["path"] = (np.asarray(crag["path"], dtype=np.float64)[:, :2] * scale).tolist()
+  return json_content
+
+class ResponseFormat(str, Enum):
+  json = "json"
+  compact = "compact"
+  binary = "binary"
+
+# Responses are built (and cached) with matched points as flat
+# [x, y, x, y, ...] lists and expanded only for the requested format:
+#   json     the original [{"point1": {"x", "y"}, "point2": {"x", "y"}}, ...]
+#   compact  {"points1": [...], "points2": [...]} as stored
+#   binary   application/octet-stream: uint32 LE length of a UTF-8 JSON header
+#            (the response with matched_points replaced by their count), the
+#            header, then float32 LE rows of (x1, y1, x2, y2)
+def compact_points(pts0, pts1):
+  return {"points1": pts0.reshape(-1).tolist(), "points2": pts1.reshape(-1).tolist()}
+
+def encode_response(response, response_format):
+  with span("serialization"):
+    return build_response(response, response_format)
+
+# matched_points in the original [{"point1": ..., "point2": ...}] form
+def expand_points(response):
+  xy1, xy2 = response["matched_points"]["points1"], response["matched_points"]["points2"]
+  return {**response, "matched_points": [
+    {"point1": {"x": xy1[i], "y": xy1[i + 1]}, "point2": {"x": xy2[i], "y": xy2[i + 1]}}
+    for i in range(0, len(xy1), 2)
+  ]}
+
+def build_response(response, response_format):
+  points = response["matched_points"]
+  if response_format == ResponseFormat.binary:
+    rows = np.hstack([np.asarray(points["points1"], dtype="<f4").reshape(-1, 2),
+                      np.asarray(points["points2"], dtype="<f4").reshape(-1, 2)])
+    header = json.dumps({**response, "matched_points": len(rows)}).encode()
+    return Response(content=struct.pack("<I", len(header)) + header + rows.tobytes(),
+                    media_type="application/octet-stream")
+  if response_format == ResponseFormat.json:
+    response = expand_points(response)
+  # content is plain JSON types already, skip jsonable_encoder
+  return JSONResponse(content=response)
+
+# Runs all model inference on one dedicated thread so the event loop stays
+# free for lightweight endpoints. Coroutines enqueue jobs and await a future;
+# match jobs that arrive within INFERENCE_BATCH_WAIT_MS of each other are
+# merged, so concurrent requests share forward passes.
+class InferenceScheduler:
+  def __init__(self, max_queue, batch_wait, timeout):
+    self.queue = queue.Queue(maxsize=max_queue)
+    self.batch_wait = batch_wait
+    self.timeout = timeout
+    self.thread = None
+    self.lock = threading.Lock()
+
+  def start(self):
+    with self.lock:
+      if self.thread is None:
+        self.thread = threading.Thread(target=self.run, name="inference", daemon=True)
+        self.thread.start()
+
+  async def submit(self, kind, payload):
+    self.start()
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    try:
+      self.queue.put_nowait((kind, payload, loop, future))
+    except queue.Full:
+      metrics.inc("inference_rejected_total")
+      raise HTTPException(status_code=503, detail="Matching service is busy, try again later")
+    try:
+      with span("inference"):
+        return await asyncio.wait_for(future, self.timeout)
+    except asyncio.TimeoutError:
+      metrics.inc("inference_timeouts_total")
+      raise HTTPException(status_code=504, detail="Matching timed out")
+
+  # list of (mkpts0, mkpts1), one per reference
+  async def match_pairs(self, query, references):
+    return await self.submit("match", [(query, reference) for reference in references])
+
+  # any other model work (e.g. descriptors), run as-is on the inference thread
+  async def call(self, fn, *args):
+    return await self.submit("call", (fn, args))
+
+  def run(self):
+    while True:
+      jobs = [self.queue.get()]
+      deadline = time.monotonic() + self.batch_wait
+      while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          break
+        try:
+          jobs.append(self.queue.get(timeout=remaining))
+        except queue.Empty:
+          break
+
+      # requests that timed out or disconnected while queued are skipped
+      jobs = [job for job in jobs if not job[3].cancelled()]
+      for kind, (fn, args), loop, future in [job for job in jobs if job[0] == "call"]:
+        try:
+          self.resolve(loop, future, fn(*args))
+        except Exception as e:
+          self.fail(loop, future, e)
+
+      match_jobs = [job for job in jobs if job[0] == "match"]
+      if match_jobs:
+        pairs = [pair for job in match_jobs for pair in job[1]]
+        metrics.observe("inference_batch_pairs", len(pairs), buckets=Metrics.COUNTS)
+        try:
+          with span("forward"):
+            results = match_image_pairs(pairs)
+        except Exception as e:
+          for _, _, loop, future in match_jobs:
+            self.fail(loop, future, e)
+          continue
+        offset = 0
+        for _, job_pairs, loop, future in match_jobs:
+          self.resolve(loop, future, results[offset:offset + len(job_pairs)])
+          offset += len(job_pairs)
+
+  def resolve(self, loop, future, result):
+    loop.call_soon_threadsafe(lambda: future.done() or future.set_result(result))
+
+  def fail(self, loop, future, exception):
+    loop.call_soon_threadsafe(lambda: future.done() or future.set_exception(exception))
+
+inference = InferenceScheduler(INFERENCE_QUEUE_SIZE, INFERENCE_BATCH_WAIT_MS / 1000, INFERENCE_TIMEOUT)
+
+@app.on_event("startup")
+async def start_inference():
+  inference.start()
+  # loading and warmup run on the inference thread; /readyz flips once done
+  loop = asyncio.get_running_loop()
+  warmup = loop.create_future()
+  warmup.add_done_callback(exit_if_warmup_failed)
+  inference.queue.put_nowait(("call", (warm_up, ()), loop, warmup))
+
+# A process that can't load or run the model would answer /readyz with 503
+# forever; log why and exit so it shows up (serve.py starts a new worker)
+def exit_if_warmup_failed(future):
+  if future.cancelled() or future.exception() is None:
+    return
+  error = future.exception()
+  traceback.print_exception(type(error), error, error.__traceback__)
+  print("Loading or warming up the model failed, exiting", flush=True)
+  os._exit(1)
+
+# the process is up; says nothing about the model
+@app.get("/healthz")
+async def healthz():
+  return {"status": "ok"}
 
-  matched_points = []
-  for pt0, pt1, inlier in zip(mkpts0, mkpts1, inliers):
-    if inlier:
-      matched_points.append({
-        "point1": {"x": pt0[0], "y": pt0[1]},
-        "point2": {"x": pt1[0], "y": pt1[1]}
-      })
+# route traffic here only once the model is loaded and warmed up
+@app.get("/readyz")
+async def readyz():
+  if not model_ready.is_set():
+    return JSONResponse(status_code=503, content={"status": "warming_up"})
+  return {"status": "ready"}
 
-  return matched_points
+# Global image descriptor: GeM pooling over LoFTR's coarse backbone features.
+# Cheap compared to dense matching and good enough to rank a region's topos.
+def global_descriptor(features):
+  with torch.no_grad():
+    feat_c = features["coarse"]
+    descriptor = feat_c.clamp(min=1e-6).pow(3).mean(dim=(2, 3)).pow(1. / 3)
+    descriptor = torch.nn.functional.normalize(descriptor, dim=1)
+  return descriptor[0].cpu().numpy().astype(np.float32)
+
+# Descriptors of every reference image of a region, stored next to the images
+# and refreshed for files whose mtime changed since they were indexed.
+class RetrievalIndex:
+  def __init__(self, folder_path):
+    name, extension = os.path.splitext(RETRIEVAL_INDEX_FILE)
+    self.path = os.path.join(folder_path, RETRIEVAL_INDEX_FILE if matcher_backend == "eager"
+                             else f"{name}.{matcher_backend}{extension}")
+    self.entries = {}
+    self.lock = threading.Lock()
+    if os.path.exists(self.path):
+      stored = np.load(self.path)
+      for name, mtime, descriptor in zip(stored["names"], stored["mtimes"], stored["descriptors"]):
+        self.entries[str(name)] = (int(mtime), descriptor)
+
+  def update(self, image_paths):
+    with self.lock:
+      changed = False
+      names = set()
+      for image_path in image_paths:
+        name = os.path.basename(image_path)
+        names.add(name)
+        mtime = os.stat(image_path).st_mtime_ns
+        entry = self.entries.get(name)
+        if entry is None or entry[0] != mtime:
+          self.entries[name] = (mtime, global_descriptor(as_features(reference_input(image_path))))
+          changed = True
+      for name in set(self.entries) - names:
+        del self.entries[name]
+        changed = True
+      if changed:
+        self.save()
+
+  def save(self):
+    names = sorted(self.entries)
+    with atomic_write(self.path) as f:
+      np.savez(f,
+        names=np.array(names),
+        mtimes=np.array([self.entries[name][0] for name in names], dtype=np.int64),
+        descriptors=np.stack([self.entries[name][1] for name in names]) if names else np.zeros((0, 0), dtype=np.float32))
+
+  # image paths ordered by cosine similarity to the query descriptor
+  def rank(self, query_descriptor, image_paths):
+    self.update(image_paths)
+    with self.lock:
+      similarities = {
+        image_path: float(np.dot(self.entries[os.path.basename(image_path)][1], query_descriptor))
+        for image_path in image_paths
+      }
+    return sorted(image_paths, key=lambda image_path: similarities[image_path], reverse=True)
+
+retrieval_indexes = {}
+retrieval_indexes_lock = threading.Lock()
+
+def get_retrieval_index(folder_path):
+  folder_path = os.path.normpath(folder_path)
+  with retrieval_indexes_lock:
+    if (folder_path, matcher_backend) not in retrieval_indexes:
+      retrieval_indexes[(folder_path, matcher_backend)] = RetrievalIndex(folder_path)
+    return retrieval_indexes[(folder_path, matcher_backend)]
+
+class SearchMode(str, Enum):
+  exhaustive = "exhaustive"
+  coarse_to_fine = "coarse_to_fine"
+
+# inlier (pts0, pts1) of the query against each candidate at full resolution
+async def match_candidates(query, compare_images):
+  inputs = await run_in_threadpool(lambda: [reference_input(img) for img in compare_images])
+  correspondences = await inference.match_pairs(query, inputs)
+  return await run_in_threadpool(lambda: [inlier_matches(mkpts0, mkpts1) for mkpts0, mkpts1 in correspondences])
+
+# Full resolution match of the query (grayscale tensor or backbone features)
+# against every candidate. Only the winner's reference tensor is loaded, for
+# its size; the candidates themselves can be matched from stored features.
+# Returns (best image, its reference tensor, its inlier (pts0, pts1), scores).
+async def exhaustive_search(query, compare_images):
+  candidates_matches = await match_candidates(query, compare_images)
+
+  best_index = max(range(len(compare_images)), key=lambda i: len(candidates_matches[i][0]))
+  scores = {img: len(matches[0]) for img, matches in zip(compare_images, candidates_matches)}
+  best_reference = await run_in_threadpool(reference_cache.get, compare_images[best_index])
+  return compare_images[best_index], best_reference, candidates_matches[best_index], scores
+
+def has_margin(scores):
+  ranked = sorted(scores, reverse=True)
+  return len(ranked) == 1 or ranked[0] >= SEARCH_MARGIN * max(ranked[1], 1)
+
+# Matches every candidate at SEARCH_COARSE_SIZE with a cheap RANSAC budget.
+# If the leader is SEARCH_MARGIN ahead of the runner-up only it is matched at
+# full resolution, otherwise the SEARCH_PROMOTE leading candidates are.
+# Returns the same as exhaustive_search plus a report of how it was decided.
+async def coarse_to_fine_search(img_bytes, query, compare_images):
+  coarse_query = (await run_in_threadpool(get_tensor_image, img_bytes, SEARCH_COARSE_SIZE))['gray']
+  references = await run_in_threadpool(
+    lambda: [reference_input(img, SEARCH_COARSE_SIZE) for img in compare_images])
+  correspondences = await inference.match_pairs(coarse_query, references)
+  coarse_scores = await run_in_threadpool(
+    lambda: [int(get_inliers(mkpts0, mkpts1, SEARCH_COARSE_RANSAC_ITERS).sum()) for mkpts0, mkpts1 in correspondences])
+
+  ranked = sorted(range(len(compare_images)), key=lambda i: coarse_scores[i], reverse=True)
+  decided_by = "coarse" if has_margin(coarse_scores) else "fine"
+  promoted = [compare_images[i] for i in ranked[:1 if decided_by == "coarse" else SEARCH_PROMOTE]]
+
+  best_match, best_tensor_match, best_matches, fine_scores = await exhaustive_search(query, promoted)
+
+  search = {
+    "mode": SearchMode.coarse_to_fine.value,
+    "decided_by": decided_by,
+    # whether the winner also kept the margin at full resolution
+    "confident": decided_by == "coarse" or has_margin(list(fine_scores.values())),
+    "coarse_scores": dict(zip(compare_images, coarse_scores)),
+    "fine_scores": fine_scores,
+  }
+  metrics.inc("coarse_to_fine_searches_total", {"decided_by": decided_by, "confident": str(search["confident"]).lower()})
+  return best_match, best_tensor_match, best_matches, search
 
 class ImageData(BaseModel):
     image_data: str
@@ -162,18 +1126,220 @@ async def calculate_local_homography(data: LocalHomographyData):
     homography_matrix = H.flatten().tolist()
     return {"homography_matrix": homography_matrix}
 
+# In-memory index of ./images: every directory, the topos in it (file name,
+# displayed size, image and JSON mtimes) and their parsed crag JSON. Built once
+# on startup; reads only stat the directories involved and reread one when
+# its mtime moved, which also picks up writes made by other workers. With
+# CATALOG_POLL_INTERVAL a polling watcher also catches files edited in place.
+# Unchanged topos are reused across rereads, so a reread only stats files.
+class RegionCatalog:
+  def __init__(self, root):
+    self.root = os.path.normpath(root)
+    # normalized directory path -> {filename: topo}
+    self.regions = {}
+    # normalized directory path -> its mtime when it was last read
+    self.mtimes = {}
+    self.loaded = False
+    self.lock = threading.Lock()
+    self.scan_lock = threading.Lock()
+
+  def load(self):
+    with self.scan_lock:
+      if not self.loaded:
+        self.rescan()
+
+  # rereads the whole tree, returns the directories whose content changed
+  def scan(self):
+    with self.scan_lock:
+      return self.rescan()
+
+  def rescan(self):
+    folders = [os.path.normpath(root) for root, dirs, files in os.walk(self.root)]
+    changed = [folder for folder in set(self.regions) - set(folders) if self.store(folder, None)]
+    changed += [folder for folder in folders if self.store(folder, self.read_folder(folder))]
+    self.loaded = True
+    return changed
+
+  # rereads one directory; a directory the catalog doesn't know yet (and its
+  # parents) is picked up by a full rescan
+  def refresh(self, folder_path):
+    folder = os.path.normpath(folder_path)
+    with self.scan_lock:
+      if not self.loaded or folder not in self.regions:
+        return folder in self.rescan()
+      return self.store(folder, self.read_folder(folder))
+
+  # A directory's mtime changes whenever an entry is added, removed or renamed
+  # over, and the write endpoints replace files atomically, so one stat tells
+  # whether any worker changed the directory since it was read. Files edited
+  # in place outside the API need the watcher.
+  def is_current(self, folder):
+    try:
+      mtime = os.stat(folder).st_mtime_ns
+    except FileNotFoundError:
+      mtime = None
+    with self.lock:
+      return self.mtimes.get(folder) == mtime
+
+  def sync(self, folder):
+    self.load()
+    if not self.is_current(folder):
+      self.refresh(folder)
+
+  # (directory mtime, {filename: topo}) or None when the directory is gone.
+  # The mtime is taken before listing, so a change racing the read only
+  # causes another reread. Timestamps are coarse, so a write landing in the
+  # same tick as the read wouldn't move the mtime: a directory changed within
+  # the last second is recorded as unknown and reread until it settles.
+  def read_folder(self, folder):
+    try:
+      mtime = os.stat(folder).st_mtime_ns
+      filenames = os.listdir(folder)
+    except FileNotFoundError:
+      return None
+    if time.time_ns() - mtime < 1_000_000_000:
+      mtime = -1
+    return mtime, self.read_topos(folder, filenames)
+
+  def read_topos(self, folder, filenames):
+    with self.lock:
+      current = self.regions.get(folder, {})
+    topos = {}
+    for filename in sorted(filenames):
+      if not filename.endswith(".jpg"):
+        continue
+      path = os.path.join(folder, filename)
+      json_path = f"{os.path.splitext(path)[0]}.json"
+      try:
+        image_mtime = os.stat(path).st_mtime_ns
+        json_mtime = os.stat(json_path).st_mtime_ns if os.path.exists(json_path) else 0
+        topo = current.get(filename)
+        if topo is None or (topo["image_mtime"], topo["json_mtime"]) != (image_mtime, json_mtime):
+          topo = self.read_topo(path, json_path, image_mtime, json_mtime)
+      except FileNotFoundError:
+        # removed while scanning
+        continue
+      topos[filename] = topo
+    return topos
+
+  def read_topo(self, path, json_path, image_mtime, json_mtime):
+    width, height, _ = read_image_header(path)
+    crag = None
+    if json_mtime:
+      try:
+        with open(json_path) as f:
+          crag = json.load(f)
+      except json.JSONDecodeError as e:
+        print(f"Skipping unreadable crag JSON {json_path}: {e}")
+    return {
+      "name": os.path.splitext(os.path.basename(path))[0],
+      "width": width,
+      "height": height,
+      "image_mtime": image_mtime,
+      "json_mtime": json_mtime,
+      "crag": crag,
+    }
+
+  # entry is read_folder's result
+  def store(self, folder, entry):
+    with self.lock:
+      if entry is None:
+        self.mtimes.pop(folder, None)
+        return self.regions.pop(folder, None) is not None
+      self.mtimes[folder], topos = entry
+      changed = self.regions.get(folder) != topos
+      self.regions[folder] = topos
+      return changed
+
+  # every directory below the root, like the os.walk the listing used to do.
+  # Directories are created or removed in a known parent, so checking the
+  # known ones is enough.
+  def directories(self):
+    self.load()
+    with self.lock:
+      folders = list(self.regions)
+    if not all(self.is_current(folder) for folder in folders):
+      self.scan()
+    with self.lock:
+      return sorted(folder for folder in self.regions if folder != self.root)
+
+  # [{"path", "name", "width", "height"}] for the topos of a region, paths
+  # joined onto folder_path as given. Raises FileNotFoundError like
+  # os.listdir for a directory that doesn't exist.
+  def images(self, folder_path):
+    folder = os.path.normpath(folder_path)
+    self.sync(folder)
+    with self.lock:
+      topos = self.regions.get(folder)
+    if topos is None:
+      raise FileNotFoundError(f"No such region directory: '{folder_path}'")
+    return [{
+      "path": os.path.join(folder_path, filename),
+      "name": topo["name"],
+      "width": topo["width"],
+      "height": topo["height"],
+    } for filename, topo in topos.items()]
+
+  def topo(self, image_path):
+    folder, filename = os.path.split(os.path.normpath(image_path))
+    self.sync(folder)
+    with self.lock:
+      return self.regions.get(folder, {}).get(filename)
+
+  # parsed crag JSON of a topo, a copy the caller may modify, or None
+  def crag(self, image_path):
+    topo = self.topo(image_path)
+    return copy.deepcopy(topo["crag"]) if topo is not None else None
+
+  def stats(self):
+    with self.lock:
+      return {
+        "directories": len(self.regions),
+        "topos": sum(len(topos) for topos in self.regions.values()),
+      }
+
+catalog = RegionCatalog("./images")
+
+# picks up topos and crag JSON edited on disk directly; cached results of a
+# changed region are dropped (the reference cache and feature store check
+# mtimes themselves)
+def watch_catalog(interval):
+  while True:
+    time.sleep(interval)
+    try:
+      changed = catalog.scan()
+    except OSError as e:
+      print(f"Region catalog rescan failed: {e}")
+      continue
+    for folder in changed:
+      result_cache.invalidate_region(folder)
+      render_cache.invalidate_region(folder)
+
+@app.on_event("startup")
+async def load_catalog():
+  await run_in_threadpool(catalog.load)
+  if CATALOG_POLL_INTERVAL > 0:
+    threading.Thread(target=watch_catalog, args=(CATALOG_POLL_INTERVAL,), name="catalog", daemon=True).start()
+
+# JSON response with a content hash as ETag, or 304 Not Modified when the
+# client's If-None-Match already names it
+def etag_response(request, content):
+  etag = f'"{hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()}"'
+  if_none_match = request.headers.get("if-none-match", "")
+  if if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]:
+    return Response(status_code=304, headers={"ETag": etag})
+  return JSONResponse(content=content, headers={"ETag": etag})
+
 def get_available_locations():
-    base_path = "./images"
     locations = []
-    for root, dirs, files in os.walk(base_path):
-        for dir_name in dirs:
-            location_path = os.path.join(root, dir_name)
-            location_name = dir_name.replace("_", " ").title()
-            locations.append({
-                "name": dir_name,
-                "label": location_name,
-                "coordinates": get_coordinates_for_location(dir_name)  # Assuming you have a function to get coordinates
-            })
+    for folder in catalog.directories():
+        dir_name = os.path.basename(folder)
+        location_name = dir_name.replace("_", " ").title()
+        locations.append({
+            "name": dir_name,
+            "label": location_name,
+            "coordinates": get_coordinates_for_location(dir_name)  # Assuming you have a function to get coordinates
+        })
     return locations
 
 def get_coordinates_for_location(location_name):
@@ -189,80 +1355,33 @@ def get_coordinates_for_location(location_name):
     return coordinates.get(location_name, {"latitude": 0, "longitude": 0})
 
 @app.get("/locations")
-async def get_locations():
+async def get_locations(request: Request):
     locations = get_available_locations()
-    return {"locations": locations}
+    return etag_response(request, {"locations": locations})
 
-@app.post("/find_matching_matrix")
-async def find_matching_matrix(data: ImageData, use_fixtures: int = Query(0)):
-  if use_fixtures == 1:
-      with open("fixtures/find_matching_matrix.json", "r") as f:
-          fixture_data = json.load(f)
-      return JSONResponse(content=fixture_data)
+# Decodes the query and runs it through the backbone once; its features are
+# reused for retrieval and for every candidate pair. With top_k only the topos
+# closest to the query's global descriptor are kept as candidates.
+# Returns (query tensor, query features, candidate image paths).
+async def prepare_region_query(img_bytes, folder_path, compare_images, top_k, route):
+  tensor1 = await run_in_threadpool(get_tensor_image, img_bytes)
+  query_features = await inference.call(extract_features, tensor1['gray'])
 
-  img_bytes = base64.b64decode(data.image_data)
-  tensor1 = get_tensor_image(img_bytes)
-  img1 = tensor1['img']
-  found_images = findFolderImages(f"./images/{regionNameToPath(data.folder_path)}")
-  compare_images = [img['path'] for img in found_images]
+  if 0 < top_k < len(compare_images):
+    compare_images = (await inference.call(
+      lambda: get_retrieval_index(folder_path).rank(global_descriptor(query_features), compare_images)))[:top_k]
+  metrics.observe("search_candidates", len(compare_images), {"route": route}, Metrics.COUNTS)
+  return tensor1, query_features, compare_images
 
-  best_match = None
-  best_score = -1
-  best_matched_points = None
-  best_tensor_match = None
+# find_matching_matrix response for the chosen topo and its inlier matches.
+# homography is the homography_pair when the caller already fitted it.
+def matching_matrix_response(tensor1, best_match, best_tensor_match, mkpts0, mkpts1, homography=None):
+  homography_matrix, homography_matrix_inv = homography or homography_pair(mkpts0, mkpts1)
 
-  for img in compare_images:
-    tensor2 = get_tensor_image(open(img, "rb").read())
-    img2 = tensor2['img']
-    matched_points = await getMatchingMatrix(img1, img2)
-    score = len(matched_points)
-
-    if score > best_score:
-      best_score = score
-      best_match = img
-      best_matched_points = matched_points
-      best_tensor_match = tensor2
-
-  # Calculate homography matrix
-  mkpts0 = np.array([[pt["point1"]["x"], pt["point1"]["y"]] for pt in best_matched_points])
-  mkpts1 = np.array([[pt["point2"]["x"], pt["point2"]["y"]] for pt in best_matched_points])
-  H, inliers = cv2.findHomography(mkpts0, mkpts1, cv2.RANSAC, 5.0)
-
-  # Convert homography matrix to the required format
-  homography_matrix = H.flatten().tolist()
-
-  # Calculate the inverse of the homography matrix
-  H_inv = np.linalg.inv(H)
-  homography_matrix_inv = H_inv.flatten().tolist()
-
-  # Replace the extension with .json in a smart way
-  base, _ = os.path.splitext(best_match)
-  best_match_json_path = f"{base}.json"
-  try:
-    best_match_json_content = json.load(open(best_match_json_path))
-  except FileNotFoundError:
-    best_match_json_content = None
-
-  # Map the points in the path property of each crag
-  if best_match_json_content and "crags" in best_match_json_content:
-      for crag in best_match_json_content["crags"]:
-          if "path" in crag:
-              crag["path"] = [
-                  [
-                      point[0] * best_tensor_match['w'] / best_tensor_match['original_w'],
-                      point[1] * best_tensor_match['h'] / best_tensor_match['original_h']
-                  ]
-                  for point in crag["path"]
-              ]
+  best_match_json_content = scale_crag_paths(catalog.crag(best_match), best_tensor_match)
 
   return {
-    "matched_points": [
-      {
-        "point1": {"x": float(pt["point1"]["x"]), "y": float(pt["point1"]["y"])},
-        "point2": {"x": float(pt["point2"]["x"]), "y": float(pt["point2"]["y"])}
-      }
-      for pt in best_matched_points
-    ],
+    "matched_points": compact_points(mkpts0, mkpts1),
     "image1": {
       "width": int(tensor1['w']),
       "height": int(tensor1['h']),
@@ -279,37 +1398,448 @@ async def find_matching_matrix(data: ImageData, use_fixtures: int = Query(0)):
     "homography_matrix_inverse": homography_matrix_inv
   }
 
-@app.post("/get_matching")
-async def get_matching(data: TwoImagesData):
-    # Convert base64 strings to tensors
-    tensor1 = get_tensor_image(base64.b64decode(data.image1))
-    img1 = tensor1['img']
-    tensor2 = get_tensor_image(base64.b64decode(data.image2))
-    img2 = tensor2['img']
+# How far the homography puts the query inliers from the topo points they
+# matched, in pixels at the matched resolution: mean |dx| and |dy| (as in
+# homeography-poc.py) and the mean euclidean distance
+def reprojection_error(pts0, pts1, H):
+  projected = cv2.perspectiveTransform(np.asarray(pts0, dtype=np.float64).reshape(-1, 1, 2), H)[:, 0]
+  offsets = projected - pts1
+  return {
+    "mean_x": float(np.abs(offsets[:, 0]).mean()),
+    "mean_y": float(np.abs(offsets[:, 1]).mean()),
+    "mean": float(np.linalg.norm(offsets, axis=1).mean()),
+  }
 
-    # Get matching points
-    matched_points = await getMatchingMatrix(img1, img2)
+# Crags of a topo (paths already at the matched resolution) with their paths
+# mapped into query coordinates, all of them in one perspectiveTransform
+def project_crag_paths(json_content, H_inv):
+  if not json_content or "crags" not in json_content:
+    return []
+  paths = [np.asarray(crag.get("path") or np.zeros((0, 2)), dtype=np.float64)[:, :2] for crag in json_content["crags"]]
+  points = np.concatenate(paths) if paths else np.zeros((0, 2))
+  if len(points):
+    points = cv2.perspectiveTransform(points.reshape(-1, 1, 2), H_inv)[:, 0]
+  projected = np.split(points, np.cumsum([len(path) for path in paths])[:-1])
+  return [{**crag, "path": path.tolist()} for crag, path in zip(json_content["crags"], projected)]
+
+# Every candidate with at least OVERLAP_MIN_INLIERS inliers and a usable
+# homography, most inliers first, with its homography pair, reprojection error
+# and crag paths in query coordinates, so overlays of several topos can be merged
+def overlapping_topos(compare_images, candidates_matches):
+  overlaps = []
+  for img, (pts0, pts1) in zip(compare_images, candidates_matches):
+    if len(pts0) < max(OVERLAP_MIN_INLIERS, 4):
+      continue
+    try:
+      homography_matrix, homography_matrix_inv = homography_pair(pts0, pts1)
+    except np.linalg.LinAlgError:
+      continue
+    reference = reference_cache.get(img)
+    H_inv = np.array(homography_matrix_inv).reshape(3, 3)
+    overlaps.append({
+      "path": img,
+      "inliers": len(pts0),
+      "image2": {
+        "width": int(reference['w']),
+        "height": int(reference['h']),
+        "original_width": int(reference['original_w']),
+        "original_height": int(reference['original_h']),
+      },
+      "homography_matrix": homography_matrix,
+      "homography_matrix_inverse": homography_matrix_inv,
+      "reprojection_error": reprojection_error(pts0, pts1, np.array(homography_matrix).reshape(3, 3)),
+      "crags": project_crag_paths(scale_crag_paths(catalog.crag(img), reference), H_inv),
+    })
+  metrics.observe("overlap_topos", len(overlaps), buckets=Metrics.COUNTS)
+  return sorted(overlaps, key=lambda overlap: overlap["inliers"], reverse=True)
 
-    # Calculate homography matrix
-    mkpts0 = np.array([[pt["point1"]["x"], pt["point1"]["y"]] for pt in matched_points])
-    mkpts1 = np.array([[pt["point2"]["x"], pt["point2"]["y"]] for pt in matched_points])
-    H, inliers = cv2.findHomography(mkpts0, mkpts1, cv2.RANSAC, 5.0)
+@app.post("/find_matching_matrix")
+async def find_matching_matrix(data: ImageData, use_fixtures: int = Query(0), top_k: int = Query(0),
+                               search: SearchMode = Query(SearchMode.exhaustive), overlap: int = Query(0),
+                               response_format: ResponseFormat = Query(ResponseFormat.json)):
+  if use_fixtures == 1:
+      with open("fixtures/find_matching_matrix.json", "r") as f:
+          fixture_data = json.load(f)
+      return JSONResponse(content=fixture_data)
 
-    # Convert homography matrix to the required format
-    homography_matrix = H.flatten().tolist()
+  img_bytes = base64.b64decode(data.image_data)
+  folder_path = f"./images/{regionNameToPath(data.folder_path)}"
+  found_images = findFolderImages(folder_path)
+  compare_images = [img['path'] for img in found_images]
 
-    # Calculate the inverse of the homography matrix
-    H_inv = np.linalg.inv(H)
-    homography_matrix_inv = H_inv.flatten().tolist()
+  cache_key = result_cache.key(img_bytes, "find_matching_matrix", folder_path, region_signature(compare_images),
+                               top_k, search.value, overlap)
+  cached = await run_in_threadpool(result_cache.get, cache_key, folder_path)
+  if cached is not None:
+    return await run_in_threadpool(encode_response, cached, response_format)
+
+  tensor1, query_features, compare_images = await prepare_region_query(
+    img_bytes, folder_path, compare_images, top_k, "/find_matching_matrix")
+
+  search_report = None
+  overlaps = None
+  homography = None
+  if overlap == 1:
+    # every candidate's matches are needed, so this always matches them all
+    # at full resolution
+    candidates_matches = await match_candidates(query_features, compare_images)
+    best_index = max(range(len(compare_images)), key=lambda i: len(candidates_matches[i][0]))
+    best_match, (mkpts0, mkpts1) = compare_images[best_index], candidates_matches[best_index]
+    best_tensor_match = await run_in_threadpool(reference_cache.get, best_match)
+    overlaps = await run_in_threadpool(overlapping_topos, compare_images, candidates_matches)
+    # the best match is fitted already when it made the overlaps
+    best_overlap = next((overlap for overlap in overlaps if overlap["path"] == best_match), None)
+    if best_overlap is not None:
+      homography = (best_overlap["homography_matrix"], best_overlap["homography_matrix_inverse"])
+  elif search == SearchMode.coarse_to_fine:
+    best_match, best_tensor_match, (mkpts0, mkpts1), search_report = await coarse_to_fine_search(
+      img_bytes, query_features, compare_images)
+  else:
+    best_match, best_tensor_match, (mkpts0, mkpts1), _ = await exhaustive_search(query_features, compare_images)
+
+  response = await run_in_threadpool(
+    matching_matrix_response, tensor1, best_match, best_tensor_match, mkpts0, mkpts1, homography)
+  if search_report is not None:
+    response["search"] = search_report
+  if overlaps is not None:
+    response["overlaps"] = overlaps
+  await run_in_threadpool(result_cache.put, cache_key, response, folder_path)
+  return await run_in_threadpool(encode_response, response, response_format)
+
+class StreamFormat(str, Enum):
+  ndjson = "ndjson"
+  sse = "sse"
+
+# one event of a streamed search: a JSON line with an "event" field for
+# ndjson, an "event:"/"data:" frame for Server-Sent Events
+def stream_event(stream_format, event, data):
+  if stream_format == StreamFormat.sse:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+  return json.dumps({"event": event, **data}) + "\n"
+
+# Streaming variant of find_matching_matrix (exhaustive search). Candidates are
+# matched MATCH_BATCH_SIZE at a time, the next batch queued while the current
+# one goes through RANSAC, and reported as they finish:
+#   candidates   {"candidates"} the topos about to be matched
+#   score        {"image", "score"} inlier count of one candidate
+#   provisional  {"best_match", "score"} whenever the leader changes
+#   result       the find_matching_matrix response plus best_match, score and
+#                all_scores as /find_match returns them
+#   error        {"status", "detail"} when matching fails after the stream began
+# The query is decoded and its candidates picked before the response starts,
+# so failures there are still plain HTTP errors. A client that disconnects
+# cancels the match jobs still queued for it.
+@app.post("/find_matching_matrix/stream")
+async def find_matching_matrix_stream(data: ImageData, request: Request, top_k: int = Query(0),
+                                      stream_format: StreamFormat = Query(StreamFormat.ndjson),
+                                      response_format: ResponseFormat = Query(ResponseFormat.json)):
+  if response_format == ResponseFormat.binary:
+    raise HTTPException(status_code=400, detail="Binary responses can't be streamed, use json or compact")
 
-    return {
-        "matched_points": [
-            {
-                "point1": {"x": float(pt["point1"]["x"]), "y": float(pt["point1"]["y"])},
-                "point2": {"x": float(pt["point2"]["x"]), "y": float(pt["point2"]["y"])}
-            }
-            for pt in matched_points
-        ],
+  img_bytes = base64.b64decode(data.image_data)
+  folder_path = f"./images/{regionNameToPath(data.folder_path)}"
+  compare_images = [img['path'] for img in findFolderImages(folder_path)]
+  if not compare_images:
+    raise HTTPException(status_code=404, detail="Region has no topos")
+  cache_key = result_cache.key(img_bytes, "find_matching_matrix_stream", folder_path, region_signature(compare_images),
+                               top_k)
+
+  def result_event(result):
+    return stream_event(stream_format, "result",
+                        expand_points(result) if response_format == ResponseFormat.json else result)
+
+  media_type = "text/event-stream" if stream_format == StreamFormat.sse else "application/x-ndjson"
+  # keep proxies from buffering the stream
+  headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+  cached = await run_in_threadpool(result_cache.get, cache_key, folder_path)
+  if cached is not None:
+    async def cached_events():
+      yield await run_in_threadpool(result_event, cached)
+    return StreamingResponse(cached_events(), media_type=media_type, headers=headers)
+
+  tensor1, query_features, candidates = await prepare_region_query(
+    img_bytes, folder_path, compare_images, top_k, "/find_matching_matrix/stream")
+
+  async def events():
+    yield stream_event(stream_format, "candidates", {"candidates": candidates})
+
+    chunks = [candidates[i:i + MATCH_BATCH_SIZE] for i in range(0, len(candidates), MATCH_BATCH_SIZE)]
+    scores = {}
+    best = None
+    pending = asyncio.ensure_future(match_candidates(query_features, chunks[0]))
+    try:
+      for index, chunk in enumerate(chunks):
+        chunk_matches = await pending
+        pending = None
+        if index + 1 < len(chunks):
+          pending = asyncio.ensure_future(match_candidates(query_features, chunks[index + 1]))
+        for image, matches in zip(chunk, chunk_matches):
+          scores[image] = len(matches[0])
+          yield stream_event(stream_format, "score", {"image": image, "score": scores[image]})
+          if best is None or scores[image] > scores[best[0]]:
+            best = (image, matches)
+            yield stream_event(stream_format, "provisional", {"best_match": image, "score": scores[image]})
+        if await request.is_disconnected():
+          metrics.inc("stream_cancelled_total")
+          return
+
+      best_match, (mkpts0, mkpts1) = best
+      best_tensor_match = await run_in_threadpool(reference_cache.get, best_match)
+      result = {
+        **(await run_in_threadpool(matching_matrix_response, tensor1, best_match, best_tensor_match, mkpts0, mkpts1)),
+        "best_match": best_match,
+        "score": scores[best_match],
+        "all_scores": scores,
+      }
+    except HTTPException as e:
+      # the 200 is already sent, e.g. the inference queue filled up or timed out
+      yield stream_event(stream_format, "error", {"status": e.status_code, "detail": e.detail})
+      return
+    except (asyncio.CancelledError, GeneratorExit):
+      metrics.inc("stream_cancelled_total")
+      raise
+    finally:
+      if pending is not None:
+        pending.cancel()
+
+    await run_in_threadpool(result_cache.put, cache_key, result, folder_path)
+    yield await run_in_threadpool(result_event, result)
+
+  return StreamingResponse(events(), media_type=media_type, headers=headers)
+
+# Per-session tracking state: the region and topo the frames match and the
+# previous frame (grayscale uint8 at the working resolution) with its inlier
+# points and the topo points they matched. LRU with an idle timeout. Without a
+# directory sessions live in this process; with one (serve.py sets it when it
+# forks) every session is an .npz file there, so whichever worker gets the
+# next frame of a session can continue it, and idle time comes from mtimes.
+class TrackingSessions:
+  def __init__(self, max_sessions, ttl, directory=None):
+    self.max_sessions = max_sessions
+    self.ttl = ttl
+    self.directory = directory
+    self.sessions = OrderedDict()
+    self.lock = threading.Lock()
+
+  @staticmethod
+  def valid_id(session_id):
+    return TRACKING_SESSION_ID.fullmatch(session_id) is not None
+
+  def path(self, session_id):
+    return os.path.join(self.directory, f"{session_id}.npz")
+
+  def get(self, session_id):
+    if self.directory:
+      path = self.path(session_id)
+      try:
+        if time.time() - os.stat(path).st_mtime > self.ttl:
+          self.remove(session_id)
+          return None
+        with np.load(path) as data:
+          return {
+            "folder_path": str(data["folder_path"]),
+            "topo": str(data["topo"]),
+            "frame": data["frame"],
+            "pts0": data["pts0"],
+            "pts1": data["pts1"],
+          }
+      except FileNotFoundError:
+        return None
+    with self.lock:
+      self.expire()
+      return self.sessions.get(session_id)
+
+  def put(self, session_id, state):
+    if self.directory:
+      os.makedirs(self.directory, exist_ok=True)
+      with atomic_write(self.path(session_id)) as f:
+        np.savez(f, **state)
+      self.prune()
+      return
+    with self.lock:
+      state["updated"] = time.monotonic()
+      self.sessions[session_id] = state
+      self.sessions.move_to_end(session_id)
+      self.expire()
+      while len(self.sessions) > self.max_sessions:
+        self.sessions.popitem(last=False)
+
+  def remove(self, session_id):
+    if self.directory:
+      try:
+        os.remove(self.path(session_id))
+        return True
+      except FileNotFoundError:
+        return False
+    with self.lock:
+      return self.sessions.pop(session_id, None) is not None
+
+  # sessions are ordered by last update, so only the oldest need checking
+  def expire(self):
+    now = time.monotonic()
+    while self.sessions and now - next(iter(self.sessions.values()))["updated"] > self.ttl:
+      self.sessions.popitem(last=False)
+
+  # drops expired session files and the oldest ones beyond max_sessions
+  def prune(self):
+    files = []
+    for filename in os.listdir(self.directory):
+      if filename.endswith(".npz"):
+        path = os.path.join(self.directory, filename)
+        try:
+          files.append((os.stat(path).st_mtime, path))
+        except FileNotFoundError:
+          pass
+    files.sort(reverse=True)
+    now = time.time()
+    for index, (mtime, path) in enumerate(files):
+      if index >= self.max_sessions or now - mtime > self.ttl:
+        try:
+          os.remove(path)
+        except FileNotFoundError:
+          pass
+
+tracking_sessions = TrackingSessions(TRACKING_SESSIONS, TRACKING_SESSION_TTL, TRACKING_DIR)
+
+def gray_frame(tensor):
+  return (tensor["gray"][0, 0] * 255).round().byte().cpu().numpy()
+
+# Follows the previous frame's inlier points into this frame with pyramidal
+# Lucas-Kanade, keeps those that track back to where they started, and refits
+# the homography to the topo points they were matched to.
+# Returns inlier (pts0, pts1) or None when too few survive.
+def track_flow(session, frame):
+  previous = session["frame"]
+  if previous.shape != frame.shape or len(session["pts0"]) < TRACKING_MIN_INLIERS:
+    return None
+  with span("tracking_flow"):
+    pts0 = session["pts0"].reshape(-1, 1, 2).astype(np.float32)
+    tracked, status, _ = cv2.calcOpticalFlowPyrLK(previous, frame, pts0, None, winSize=(21, 21), maxLevel=3)
+    back, back_status, _ = cv2.calcOpticalFlowPyrLK(frame, previous, tracked, None, winSize=(21, 21), maxLevel=3)
+    good = (status[:, 0] == 1) & (back_status[:, 0] == 1) & (np.linalg.norm(back - pts0, axis=2)[:, 0] < 1.0)
+    if good.sum() < TRACKING_MIN_INLIERS:
+      return None
+    tracked, pts1 = tracked[good, 0], session["pts1"][good]
+    H, mask = cv2.findHomography(tracked, pts1, cv2.RANSAC, 5.0)
+  if H is None or mask.sum() < TRACKING_MIN_INLIERS:
+    return None
+  inliers = mask[:, 0].astype(bool)
+  return tracked[inliers], pts1[inliers]
+
+# Matches the frame, downscaled to TRACKING_SIZE, against the session's topo
+# only. Returns inlier (pts0, pts1) at the working resolution, or None.
+async def track_loftr(session, frame, reference):
+  scale = TRACKING_SIZE / max(frame.shape)
+  small = cv2.resize(frame, (int(frame.shape[1] * scale), int(frame.shape[0] * scale)), interpolation=cv2.INTER_AREA)
+  query = (image_to_tensor(small).float() / 255.).to(device)
+  small_reference = await run_in_threadpool(reference_cache.get, session["topo"], TRACKING_SIZE)
+  reference_features = await run_in_threadpool(reference_input, session["topo"], TRACKING_SIZE)
+  mkpts0, mkpts1 = (await inference.match_pairs(query, [reference_features]))[0]
+  pts0, pts1 = await run_in_threadpool(inlier_matches, mkpts0, mkpts1)
+  if len(pts0) < TRACKING_MIN_INLIERS:
+    return None
+  pts0 = pts0 * np.array([frame.shape[1] / small.shape[1], frame.shape[0] / small.shape[0]])
+  pts1 = pts1 * np.array([reference["w"] / small_reference["w"], reference["h"] / small_reference["h"]])
+  return pts0.astype(np.float32), pts1.astype(np.float32)
+
+class TrackingFrame(BaseModel):
+    image_data: str
+    folder_path: str
+    session_id: Optional[str] = None
+
+# Overlay updates for a phone panning over a crag. The first frame of a session
+# runs a full region search; later frames are tracked against the topo found:
+#   flow    optical flow of the previous frame's inliers + findHomography
+#   loftr   low resolution LoFTR against that one topo
+#   search  full region search, when neither keeps TRACKING_MIN_INLIERS
+# The response is the find_matching_matrix one plus session_id and
+# tracking {"method", "inliers"}; send session_id back with the next frame.
+@app.post("/track")
+async def track_frame(data: TrackingFrame, search: SearchMode = Query(SearchMode.exhaustive),
+                      response_format: ResponseFormat = Query(ResponseFormat.json)):
+  img_bytes = base64.b64decode(data.image_data)
+  folder_path = f"./images/{regionNameToPath(data.folder_path)}"
+  session_id = data.session_id or uuid.uuid4().hex
+  if not tracking_sessions.valid_id(session_id):
+    raise HTTPException(status_code=400, detail="Invalid session_id")
+  tensor1 = await run_in_threadpool(get_tensor_image, img_bytes)
+  frame = await run_in_threadpool(gray_frame, tensor1)
+
+  session = await run_in_threadpool(tracking_sessions.get, session_id)
+  if session is not None and session["folder_path"] != folder_path:
+    session = None
+
+  if session is not None:
+    topo = session["topo"]
+    try:
+      reference = await run_in_threadpool(reference_cache.get, topo)
+    except FileNotFoundError:
+      # the topo was deleted since the last frame, search the region again
+      tracking_sessions.remove(session_id)
+      session = None
+
+  matches = None
+  if session is not None:
+    method = "flow"
+    matches = await run_in_threadpool(track_flow, session, frame)
+    if matches is None:
+      method = "loftr"
+      matches = await track_loftr(session, frame, reference)
+
+  if matches is None:
+    method = "search"
+    compare_images = [img['path'] for img in findFolderImages(folder_path)]
+    query_features = await inference.call(extract_features, tensor1['gray'])
+    if search == SearchMode.coarse_to_fine:
+      topo, reference, matches, _ = await coarse_to_fine_search(img_bytes, query_features, compare_images)
+    else:
+      topo, reference, matches, _ = await exhaustive_search(query_features, compare_images)
+    if len(matches[0]) < 4:
+      tracking_sessions.remove(session_id)
+      raise HTTPException(status_code=422, detail="Frame doesn't match any topo of the region")
+  metrics.inc("tracking_frames_total", {"method": method})
+
+  pts0, pts1 = matches
+  response = await run_in_threadpool(matching_matrix_response, tensor1, topo, reference, pts0, pts1)
+  response["session_id"] = session_id
+  response["tracking"] = {"method": method, "inliers": len(pts0)}
+  await run_in_threadpool(tracking_sessions.put, session_id, {
+    "folder_path": folder_path,
+    "topo": topo,
+    "frame": frame,
+    "pts0": np.asarray(pts0, dtype=np.float32).reshape(-1, 2),
+    "pts1": np.asarray(pts1, dtype=np.float32).reshape(-1, 2),
+  })
+  return await run_in_threadpool(encode_response, response, response_format)
+
+@app.delete("/track/{session_id}")
+async def end_tracking(session_id: str):
+  if not tracking_sessions.valid_id(session_id) or not tracking_sessions.remove(session_id):
+    raise HTTPException(status_code=404, detail="Unknown tracking session")
+  return {"status": "ok"}
+
+@app.post("/get_matching")
+async def get_matching(data: TwoImagesData, response_format: ResponseFormat = Query(ResponseFormat.json)):
+    img1_bytes = base64.b64decode(data.image1)
+    img2_bytes = base64.b64decode(data.image2)
+    cache_key = result_cache.key(img1_bytes, img2_bytes, "get_matching")
+    cached = await run_in_threadpool(result_cache.get, cache_key)
+    if cached is not None:
+        return await run_in_threadpool(encode_response, cached, response_format)
+
+    # Convert base64 strings to tensors
+    tensor1 = await run_in_threadpool(get_tensor_image, img1_bytes)
+    img1 = tensor1['gray']
+    tensor2 = await run_in_threadpool(get_tensor_image, img2_bytes)
+    img2 = tensor2['gray']
+
+    # Get matching points
+    mkpts0, mkpts1 = await getMatchingMatrix(img1, img2)
+    homography_matrix, homography_matrix_inv = await run_in_threadpool(homography_pair, mkpts0, mkpts1)
+
+    response = {
+        "matched_points": compact_points(mkpts0, mkpts1),
         "image1": {
             "width": int(tensor1['w']),
             "height": int(tensor1['h']),
@@ -321,53 +1851,48 @@ async def get_matching(data: TwoImagesData):
         "homography_matrix": homography_matrix,
         "homography_matrix_inverse": homography_matrix_inv
     }
+    await run_in_threadpool(result_cache.put, cache_key, response)
+    return await run_in_threadpool(encode_response, response, response_format)
 
 
 
 @app.post("/get_matching_with")
-async def get_matching_with(image1: UploadFile = File(...), image_path: str = ""):
-  img1 = get_tensor_image(await image1.read())['img']
-  img2 = get_tensor_image(open(image_path, "rb").read())['img']
-  return await process_matching(img1, img2)
-
-async def getSimilarityScore(tensorImage1, tensorImage2):
-  input_dict = {"image0": K.color.rgb_to_grayscale(tensorImage1),
-      "image1": K.color.rgb_to_grayscale(tensorImage2)}
-  
-  with torch.no_grad():
-    correspondences = matcher(input_dict)
-    mkpts0 = correspondences['keypoints0'].cpu().numpy()
-    mkpts1 = correspondences['keypoints1'].cpu().numpy()
-    Fm, inliers = cv2.findFundamentalMat(mkpts0, mkpts1, cv2.USAC_MAGSAC, 0.5, 0.999999, 10000)
-    inliers = inliers > 0
-
-  return inliers.sum()
-  
+async def get_matching_with(image1: UploadFile = File(...), image_path: str = "",
+                            max_size: int = Query(0), quality: int = Query(90, ge=1, le=100)):
+  img1_bytes = await image1.read()
+  folder_path = os.path.dirname(image_path)
+  cache_key = render_cache.key(img1_bytes, image_path, os.stat(image_path).st_mtime_ns, max_size, quality)
+  rendered = render_cache.get(cache_key, folder_path)
+
+  if rendered is None:
+    tensor1 = await run_in_threadpool(get_tensor_image, img1_bytes, 840, True)
+    tensor2 = await run_in_threadpool(lambda: get_tensor_image(open(image_path, "rb").read(), color=True))
+    rendered = await process_matching(tensor1, tensor2, max_size, quality)
+    render_cache.put(cache_key, rendered, folder_path)
+
+  return Response(content=rendered, media_type="image/jpeg")
+
+# path, name (without extension) and displayed size of every topo in a region
 def findFolderImages(folder_path):
-  images = []
-  for filename in os.listdir(folder_path):
-    if filename.endswith(".jpg"):
-      images.append({
-        "path": os.path.join(folder_path, filename),
-        # name without extension
-        "name": os.path.splitext(filename)[0]
-      })
-  return images
+  return catalog.images(folder_path)
 
 def regionNameToPath(region_name):
   return region_name.replace("_", "/")
 
 @app.post("/find_match")
 async def find_match(folder_path: str, image1: UploadFile = File(...)):
-  img1 = get_tensor_image(await image1.read())['img']
+  img1 = (await run_in_threadpool(get_tensor_image, await image1.read()))['gray']
   found_images = findFolderImages(f"./images/{regionNameToPath(folder_path)}")
   compare_images = [img['path'] for img in found_images]
 
+  metrics.observe("search_candidates", len(compare_images), {"route": "/find_match"}, Metrics.COUNTS)
+  references = await run_in_threadpool(lambda: [reference_input(img) for img in compare_images])
+  correspondences = await inference.match_pairs(img1, references)
+  inlier_counts = await run_in_threadpool(
+    lambda: [get_inliers(mkpts0, mkpts1).sum() for mkpts0, mkpts1 in correspondences])
   scores = []
 
-  for img in compare_images:
-    img2 = get_tensor_image(open(img, "rb").read())['img']
-    score = await getSimilarityScore(img1, img2)
+  for score in inlier_counts:
     scores.append(int(score))  # Convert NumPy int64 to native Python int
 
   best_match_index = scores.index(max(scores))
@@ -378,30 +1903,76 @@ async def find_match(folder_path: str, image1: UploadFile = File(...)):
 
   return {"best_match": best_match, "score": best_score, "all_scores": all_scores}
 
+def current_rss_bytes():
+  try:
+    with open("/proc/self/statm") as f:
+      return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+  except (OSError, ValueError):
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def device_memory():
+  if device.type == "cuda":
+    return [({"kind": "allocated"}, torch.cuda.memory_allocated(device)),
+            ({"kind": "reserved"}, torch.cuda.memory_reserved(device))]
+  return [({"kind": "rss"}, current_rss_bytes())]
+
+def cache_hit_ratios():
+  caches = {"references": reference_cache, "results": result_cache, "renders": render_cache}
+  return [({"cache": name}, cache.hits / (cache.hits + cache.misses) if cache.hits + cache.misses else 0)
+          for name, cache in caches.items()]
+
+metrics.gauge("inference_queue_depth", lambda: inference.queue.qsize())
+metrics.gauge("cache_hit_ratio", cache_hit_ratios)
+metrics.counter("cache_lookups_total", lambda: [
+  ({"cache": name, "result": result}, getattr(cache, result))
+  for name, cache in {"references": reference_cache, "results": result_cache, "renders": render_cache}.items()
+  for result in ("hits", "misses")])
+metrics.gauge("device_memory_bytes", device_memory)
+
+@app.on_event("startup")
+async def start_metrics_refresh():
+  if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+    threading.Thread(target=metrics.refresh_periodically, args=(METRICS_FLUSH_INTERVAL,), name="metrics", daemon=True).start()
+
+@app.get("/metrics")
+async def get_metrics():
+  return Response(content=await run_in_threadpool(metrics.render), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+  return {"results": result_cache.stats(), "renders": render_cache.stats(), "catalog": catalog.stats()}
+
 @app.get("/images/{rest_of_path:path}")
 async def get_image(rest_of_path: str):
   return FileResponse(f"./images/{rest_of_path}", media_type="image/jpeg")
 
 @app.get("/region/{region_name}")
-async def get_region(region_name: str):
+async def get_region(region_name: str, request: Request):
   folder_path = f"./images/{regionNameToPath(region_name)}"
   found = findFolderImages(folder_path)
-  return found
+  return etag_response(request, found)
 
 @app.post("/region")
 async def post_region(region_data: RegionData):
     folder_path = f"./images/{regionNameToPath(region_data.region_name)}"
     os.makedirs(folder_path, exist_ok=False)
+    await run_in_threadpool(catalog.refresh, folder_path)
     return {"status": "ok"}
 
 @app.get("/crag/{region_name}/{crag_name}")
 async def get_crag(region_name: str, crag_name: str):
   folder_path = f"./images/{regionNameToPath(region_name)}"
   json_path = f"{folder_path}/{crag_name}.json"
-  try:
-    data = json.load(open(json_path))
-  except FileNotFoundError:
-    data = None
+  topo = catalog.topo(f"{folder_path}/{crag_name}.jpg")
+  if topo is not None:
+    data = copy.deepcopy(topo["crag"])
+  else:
+    # a crag JSON without its topo image is not in the catalog
+    try:
+      data = json.load(open(json_path))
+    except FileNotFoundError:
+      data = None
   return {
     "data": data,
     "image": f"{folder_path}/{crag_name}.jpg"
@@ -411,8 +1982,13 @@ async def get_crag(region_name: str, crag_name: str):
 async def put_crag(region_name: str, crag_name: str, data: dict):
   folder_path = f"./images/{regionNameToPath(region_name)}"
   json_path = f"{folder_path}/{crag_name}.json"
-  with open(json_path, "w") as f:
+  # replaced atomically so other workers see the region directory change
+  with atomic_write(json_path, "w") as f:
     json.dump(data, f)
+  await run_in_threadpool(catalog.refresh, folder_path)
+  reference_cache.invalidate(f"{folder_path}/{crag_name}.jpg")
+  await run_in_threadpool(result_cache.invalidate_region, folder_path)
+  render_cache.invalidate_region(folder_path)
   return {"status": "ok"}
 
 @app.post("/region/{region_name}/crag")
@@ -428,11 +2004,43 @@ async def add_crag(region_name: str, crag_data: CragData):
         "path": []
     }
 
-    with open(json_path, "w") as f:
+    with atomic_write(json_path, "w") as f:
         json.dump(crag_data_dict, f)
 
     img_bytes = base64.b64decode(crag_data.image)
-    with open(image_path, "wb") as img_file:
+    with atomic_write(image_path) as img_file:
         img_file.write(img_bytes)
+    await run_in_threadpool(catalog.refresh, folder_path)
+    reference_cache.invalidate(image_path)
+    await run_in_threadpool(result_cache.invalidate_region, folder_path)
+    render_cache.invalidate_region(folder_path)
+    feature_store.remove(image_path)
+    for size in PRECOMPUTE_SIZES:
+      await inference.call(feature_store.precompute, image_path, size)
+    await inference.call(
+      lambda: get_retrieval_index(folder_path).update([img["path"] for img in findFolderImages(folder_path)]))
+
+    return {"status": "ok"}
 
-    return {"status": "ok"}
\ No newline at end of file
+# python main.py precompute [region ...] stores backbone features for every
+# topo of the given regions (all regions by default)
+def precompute_command(args):
+  regions = args.regions or [os.path.relpath(root, "./images").replace(os.sep, "_")
+                             for root, dirs, files in os.walk("./images") if any(f.endswith(".jpg") for f in files)]
+  for region in regions:
+    for found in findFolderImages(f"./images/{regionNameToPath(region)}"):
+      for size in args.sizes:
+        start = time.perf_counter()
+        feature_store.precompute(found["path"], size)
+        print(f"{found['path']} @{size}px: {time.perf_counter() - start:.2f}s")
+
+if __name__ == "__main__":
+  import argparse
+  parser = argparse.ArgumentParser()
+  commands = parser.add_subparsers(dest="command", required=True)
+  precompute = commands.add_parser("precompute", help="store reference backbone features")
+  precompute.add_argument("regions", nargs="*")
+  precompute.add_argument("--sizes", type=int, nargs="*", default=PRECOMPUTE_SIZES)
+  precompute.set_defaults(run=precompute_command)
+  args = parser.parse_args()
+  args.run(args)
@@ -0,0 +1,159 @@
+# Production entry point. Loads the model once, then forks N uvicorn workers
+# that accept on one shared socket. Workers share the weights and every
+# reference image preloaded here copy-on-write, and split the CPU cores
+# between their torch/OpenCV thread pools instead of oversubscribing them.
+# Precomputed features are memory-mapped, so they share the page cache.
+# usage: python serve.py --workers 4 --port 8000
+import argparse
+import atexit
+import glob
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import time
+
+import cv2
+import torch
+
+# The parent must not start torch's OpenMP pool (or OpenCV's) before forking:
+# a child inheriting a started pool can deadlock on its first parallel op.
+torch.set_num_threads(1)
+cv2.setNumThreads(0)
+
+# prometheus_client picks multiprocess mode when it is imported, so the
+# directory the workers share their metrics through is set up before main is.
+# Files left by a previous run are removed, otherwise its totals carry over.
+if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+  for path in glob.glob(os.path.join(os.environ["PROMETHEUS_MULTIPROC_DIR"], "*.db")):
+    os.remove(path)
+else:
+  os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="topomatch-metrics-")
+  atexit.register(shutil.rmtree, os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+
+import uvicorn
+from prometheus_client import multiprocess
+
+import main
+
+# A worker that exits within RESTART_WINDOW seconds of starting counts as a
+# failed start. Restarts after failed starts back off exponentially, and
+# after MAX_FAILED_STARTS in a row (e.g. a warmup that always fails) the
+# server gives up instead of respawning forever.
+RESTART_WINDOW = 30
+MAX_RESTART_DELAY = 30
+MAX_FAILED_STARTS = 5
+
+
+def parse_args():
+  cpus = os.cpu_count() or 1
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--host", default="0.0.0.0")
+  parser.add_argument("--port", type=int, default=8000)
+  parser.add_argument("--workers", type=int, default=int(os.environ.get("WORKERS", cpus)))
+  parser.add_argument("--threads-per-worker", type=int, default=0, help="default: cores / workers")
+  parser.add_argument("--preload", action="store_true", help="decode every topo before forking")
+  args = parser.parse_args()
+  args.threads_per_worker = args.threads_per_worker or max(1, cpus // args.workers)
+  return args
+
+
+def preload_references():
+  for root, dirs, files in os.walk("./images"):
+    for found in main.findFolderImages(root):
+      main.reference_cache.get(found["path"])
+  print(f"Preloaded {len(main.reference_cache.entries)} reference images")
+
+
+def run_worker(sock, threads):
+  torch.set_num_threads(threads)
+  cv2.setNumThreads(threads)
+  uvicorn.Server(uvicorn.Config(main.app, log_level="info")).run(sockets=[sock])
+
+
+def spawn(sock, threads):
+  pid = os.fork()
+  if pid == 0:
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    try:
+      run_worker(sock, threads)
+    finally:
+      os._exit(0)
+  return pid
+
+
+def run():
+  args = parse_args()
+  # index ./images once here instead of in every worker
+  main.catalog.load()
+  if args.preload:
+    preload_references()
+  main.load_matcher().share_memory()
+
+  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  sock.bind((args.host, args.port))
+  sock.listen(2048)
+  sock.set_inheritable(True)
+
+  # CUDA can't be used from a process forked after it was initialised
+  if main.device.type == "cuda" or args.workers == 1:
+    print(f"Serving in a single process on {main.device}")
+    run_worker(sock, os.cpu_count() or 1)
+    return
+
+  print(f"Serving with {args.workers} workers x {args.threads_per_worker} threads")
+  # every worker would otherwise report the cache lookups of preloading
+  main.reference_cache.hits = main.reference_cache.misses = 0
+  # frames of one tracking session land on any worker
+  own_tracking_dir = main.tracking_sessions.directory is None
+  if own_tracking_dir:
+    shm = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    main.tracking_sessions.directory = tempfile.mkdtemp(prefix="topomatch-tracking-", dir=shm)
+  children = {spawn(sock, args.threads_per_worker): time.monotonic() for _ in range(args.workers)}
+  stopping = False
+  failed_starts = 0
+
+  def stop(signum, frame):
+    nonlocal stopping
+    stopping = True
+    for pid in children:
+      os.kill(pid, signal.SIGTERM)
+
+  signal.signal(signal.SIGTERM, stop)
+  signal.signal(signal.SIGINT, stop)
+
+  while children:
+    try:
+      pid, status = os.wait()
+    except ChildProcessError:
+      break
+    started = children.pop(pid, None)
+    # drops its gauges, its counters stay in the totals
+    multiprocess.mark_process_dead(pid)
+    if stopping or started is None:
+      continue
+    if time.monotonic() - started < RESTART_WINDOW:
+      failed_starts += 1
+    else:
+      failed_starts = 0
+    if failed_starts >= MAX_FAILED_STARTS:
+      print(f"Worker {pid} exited with status {status}, {failed_starts} failed starts in a row, giving up")
+      stop(None, None)
+      continue
+    delay = min(MAX_RESTART_DELAY, 2 ** failed_starts - 1)
+    print(f"Worker {pid} exited with status {status}, starting a new one in {delay}s")
+    time.sleep(delay)
+    if not stopping:
+      children[spawn(sock, args.threads_per_worker)] = time.monotonic()
+
+  if own_tracking_dir:
+    shutil.rmtree(main.tracking_sessions.directory, ignore_errors=True)
+  if failed_starts >= MAX_FAILED_STARTS:
+    raise SystemExit(1)
+
+
+if __name__ == "__main__":
+  run()
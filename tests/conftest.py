@@ -0,0 +1,7 @@
+# run from the repository root: python -m pytest tests
+# main is imported as a module; the model is only loaded by the startup hook,
+# which the tests never trigger
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
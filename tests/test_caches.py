@@ -0,0 +1,149 @@
+import os
+
+import cv2
+import numpy as np
+
+import main
+
+
+def write_jpeg(path, w=128, h=96, value=128):
+  cv2.imwrite(str(path), np.full((h, w, 3), value, dtype=np.uint8))
+  return str(path)
+
+
+def bump_mtime(path):
+  stat = os.stat(path)
+  os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+
+
+def cached_names(cache):
+  return [os.path.basename(path) for path, size in cache.entries]
+
+
+def test_reference_cache_reuses_entries_until_the_file_changes(tmp_path):
+  path = write_jpeg(tmp_path / "topo.jpg")
+  cache = main.ReferenceCache(1 << 30)
+  first = cache.get(path)
+  assert cache.get(path) is first
+
+  bump_mtime(path)
+  assert cache.get(path) is not first
+  assert len(cache.entries) == 1
+
+
+def test_reference_cache_keys_by_size(tmp_path):
+  path = write_jpeg(tmp_path / "topo.jpg")
+  cache = main.ReferenceCache(1 << 30)
+  small = cache.get(path, 32)
+  assert max(small["w"], small["h"]) == 32
+  assert max(cache.get(path)["w"], cache.get(path)["h"]) == 840
+  assert cache.get(path, 32) is small
+  assert len(cache.entries) == 2
+
+
+def test_reference_cache_evicts_least_recently_used(tmp_path):
+  paths = [write_jpeg(tmp_path / f"{name}.jpg") for name in "abc"]
+  entry = main.ReferenceCache(1 << 30).get(paths[0])
+  cache = main.ReferenceCache(entry["nbytes"] * 2)
+  cache.get(paths[0])
+  cache.get(paths[1])
+  cache.get(paths[0])
+  cache.get(paths[2])
+  assert cached_names(cache) == ["a.jpg", "c.jpg"]
+  assert cache.total_bytes == entry["nbytes"] * 2
+
+
+def test_reference_cache_keeps_one_entry_over_budget(tmp_path):
+  cache = main.ReferenceCache(1)
+  cache.get(write_jpeg(tmp_path / "a.jpg"))
+  cache.get(write_jpeg(tmp_path / "b.jpg"))
+  assert cached_names(cache) == ["b.jpg"]
+
+
+def test_reference_cache_invalidate_drops_every_size(tmp_path):
+  path = write_jpeg(tmp_path / "topo.jpg")
+  other = write_jpeg(tmp_path / "other.jpg")
+  cache = main.ReferenceCache(1 << 30)
+  cache.get(path)
+  cache.get(path, 32)
+  cache.get(other)
+  cache.invalidate(path)
+  assert cached_names(cache) == ["other.jpg"]
+  assert cache.total_bytes == cache.get(other)["nbytes"]
+
+
+def test_result_cache_evicts_least_recently_used():
+  cache = main.ResultCache(2)
+  cache.put("a", {"value": 1})
+  cache.put("b", {"value": 2})
+  assert cache.get("a") == {"value": 1}
+  cache.put("c", {"value": 3})
+  assert cache.get("b") is None
+  assert cache.get("a") == {"value": 1}
+  assert cache.get("c") == {"value": 3}
+  assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_result_cache_key(monkeypatch):
+  key = main.ResultCache.key(b"query", "./images/stokowka", 840)
+  assert main.ResultCache.key(b"query", "./images/stokowka", 840) == key
+  assert main.ResultCache.key(b"query", "./images/stokowka", 640) != key
+  assert main.ResultCache.key(b"other", "./images/stokowka", 840) != key
+  # backends don't produce the same matches
+  monkeypatch.setattr(main, "matcher_backend", "int8")
+  assert main.ResultCache.key(b"query", "./images/stokowka", 840) != key
+
+
+def test_result_cache_invalidate_region(tmp_path):
+  cache = main.ResultCache(8, str(tmp_path))
+  cache.put("a", {"value": 1}, "./images/stokowka")
+  cache.put("b", {"value": 2}, "./images/podzamcze")
+  cache.invalidate_region("images/stokowka")
+  assert cache.get("a", "./images/stokowka") is None
+  assert cache.get("b", "./images/podzamcze") == {"value": 2}
+
+  # the disk tier of another worker is dropped too
+  fresh = main.ResultCache(8, str(tmp_path))
+  assert fresh.get("a", "./images/stokowka") is None
+  assert fresh.get("b", "./images/podzamcze") == {"value": 2}
+
+
+def test_result_cache_disk_tier_is_shared(tmp_path):
+  main.ResultCache(8, str(tmp_path)).put("a", {"value": 1}, "./images/stokowka")
+  other = main.ResultCache(8, str(tmp_path))
+  assert other.get("a", "./images/stokowka") == {"value": 1}
+  assert other.hits == 1
+  # served from memory afterwards
+  for path in tmp_path.rglob("*.json"):
+    path.unlink()
+  assert other.get("a", "./images/stokowka") == {"value": 1}
+
+
+def disk_files(directory):
+  return sorted(path.stem for path in directory.rglob("*.json"))
+
+
+def test_result_cache_prunes_disk_tier(tmp_path):
+  cache = main.ResultCache(100, str(tmp_path), max_disk_entries=10)
+  for i in range(11):
+    cache.put(f"{i:02}", {"value": i})
+  # the 11th file pushes it over the cap, pruned down to 90% of it
+  assert len(disk_files(tmp_path)) == 9
+  assert "10" in disk_files(tmp_path)
+
+  for i in range(11, 30):
+    cache.put(f"{i:02}", {"value": i})
+  assert len(disk_files(tmp_path)) <= 10
+  assert "29" in disk_files(tmp_path)
+
+
+def test_result_cache_prune_keeps_recently_read_files(tmp_path):
+  cache = main.ResultCache(100, str(tmp_path), max_disk_entries=4)
+  for i in range(4):
+    cache.put(str(i), {"value": i})
+  for i, path in enumerate(sorted(tmp_path.rglob("*.json"))):
+    os.utime(path, ns=(0, 1_000_000_000 * (i + 1)))
+  # a read on another worker touches the oldest file
+  main.ResultCache(100, str(tmp_path)).get("0")
+  cache.put("4", {"value": 4})
+  assert disk_files(tmp_path) == ["0", "3", "4"]
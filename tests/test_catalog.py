@@ -0,0 +1,74 @@
+import cv2
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+def write_topo(path):
+  cv2.imwrite(str(path), np.zeros((30, 40, 3), dtype=np.uint8))
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+  # the endpoints read ./images, so give them a fresh one
+  monkeypatch.chdir(tmp_path)
+  region = tmp_path / "images" / "stokowka"
+  region.mkdir(parents=True)
+  write_topo(region / "topo.jpg")
+  monkeypatch.setattr(main, "catalog", main.RegionCatalog("./images"))
+  return TestClient(main.app)
+
+
+@pytest.mark.parametrize("url", ["/locations", "/region/stokowka"])
+def test_etag_not_modified(client, url):
+  first = client.get(url)
+  assert first.status_code == 200
+  etag = first.headers["etag"]
+  assert etag.startswith('"') and etag.endswith('"')
+
+  again = client.get(url, headers={"If-None-Match": etag})
+  assert again.status_code == 304
+  assert again.headers["etag"] == etag
+  assert again.content == b""
+
+  assert client.get(url, headers={"If-None-Match": f'"stale", {etag}'}).status_code == 304
+  assert client.get(url, headers={"If-None-Match": "*"}).status_code == 304
+  assert client.get(url, headers={"If-None-Match": '"stale"'}).status_code == 200
+
+
+def test_region_listing(client):
+  assert client.get("/region/stokowka").json() == [
+    {"path": "./images/stokowka/topo.jpg", "name": "topo", "width": 40, "height": 30},
+  ]
+  assert client.get("/locations").json()["locations"][0]["name"] == "stokowka"
+
+
+def test_crag_updates_reach_the_listing(client):
+  assert client.get("/crag/stokowka/topo").json()["data"] is None
+  assert client.put("/crag/stokowka/topo", json={"crags": []}).json() == {"status": "ok"}
+  assert client.get("/crag/stokowka/topo").json()["data"] == {"crags": []}
+
+
+def test_crag_json_without_an_image(client, tmp_path):
+  (tmp_path / "images" / "stokowka" / "draft.json").write_text('{"crags": [{"name": "arete"}]}')
+  crag = client.get("/crag/stokowka/draft").json()
+  assert crag["data"] == {"crags": [{"name": "arete"}]}
+  assert client.get("/crag/stokowka/missing").json()["data"] is None
+
+
+def test_listings_follow_writes_made_elsewhere(client, tmp_path):
+  # another worker, or a file copied in, changes the directory
+  etag = client.get("/region/stokowka").headers["etag"]
+  write_topo(tmp_path / "images" / "stokowka" / "other.jpg")
+  changed = client.get("/region/stokowka", headers={"If-None-Match": etag})
+  assert changed.status_code == 200
+  assert changed.headers["etag"] != etag
+  assert [topo["name"] for topo in changed.json()] == ["other", "topo"]
+
+  etag = client.get("/locations").headers["etag"]
+  (tmp_path / "images" / "podzamcze").mkdir()
+  changed = client.get("/locations", headers={"If-None-Match": etag})
+  assert changed.status_code == 200
+  assert [location["name"] for location in changed.json()["locations"]] == ["podzamcze", "stokowka"]
@@ -0,0 +1,84 @@
+import cv2
+import numpy as np
+import pytest
+
+import main
+
+# moves every point by (+2, -1)
+TRANSLATION = np.array([[1, 0, 2], [0, 1, -1], [0, 0, 1]], dtype=np.float64)
+
+
+def test_reprojection_error_is_zero_for_an_exact_homography():
+  pts0 = np.float32([[0, 0], [10, 5], [40, 30], [7, 90]])
+  error = main.reprojection_error(pts0, pts0 + [2, -1], TRANSLATION)
+  assert error == pytest.approx({"mean_x": 0, "mean_y": 0, "mean": 0}, abs=1e-6)
+
+
+def test_reprojection_error_reports_axis_and_euclidean_means():
+  pts0 = np.float32([[0, 0], [10, 5], [40, 30]])
+  error = main.reprojection_error(pts0, pts0, TRANSLATION)
+  assert error == pytest.approx({"mean_x": 2, "mean_y": 1, "mean": 5 ** 0.5})
+
+
+def test_reprojection_error_with_a_projective_homography():
+  H = np.array([[1.1, 0.05, 3], [-0.02, 0.95, 7], [1e-4, 2e-4, 1]])
+  pts0 = np.float32([[0, 0], [100, 20], [300, 250], [50, 400]])
+  pts1 = cv2.perspectiveTransform(pts0.reshape(-1, 1, 2).astype(np.float64), H)[:, 0]
+  assert main.reprojection_error(pts0, pts1, H)["mean"] == pytest.approx(0, abs=1e-6)
+
+
+def test_project_crag_paths_without_crags():
+  assert main.project_crag_paths(None, TRANSLATION) == []
+  assert main.project_crag_paths({"name": "topo"}, TRANSLATION) == []
+  assert main.project_crag_paths({"crags": []}, TRANSLATION) == []
+
+
+def test_project_crag_paths_maps_every_path():
+  content = {"crags": [
+    {"name": "arete", "grade": "6a", "path": [[0, 0], [10, 20]]},
+    {"name": "no line yet"},
+    {"name": "crack", "path": [[5, 5, 1]]},
+  ]}
+  projected = main.project_crag_paths(content, TRANSLATION)
+  assert [crag["name"] for crag in projected] == ["arete", "no line yet", "crack"]
+  assert projected[0]["grade"] == "6a"
+  assert np.allclose(projected[0]["path"], [[2, -1], [12, 19]])
+  assert projected[1]["path"] == []
+  # extra coordinates are dropped
+  assert np.allclose(projected[2]["path"], [[7, 4]])
+  # the input is left alone
+  assert content["crags"][0]["path"] == [[0, 0], [10, 20]]
+
+
+def test_project_crag_paths_inverts_a_match():
+  H = np.array([[0.9, 0.1, 12], [-0.05, 1.2, -4], [2e-4, -1e-4, 1]])
+  path = [[10, 10], [200, 40], [150, 300]]
+  in_topo = cv2.perspectiveTransform(np.float64([path]), H)[0].tolist()
+  projected = main.project_crag_paths({"crags": [{"path": in_topo}]}, np.linalg.inv(H))
+  assert np.allclose(projected[0]["path"], path, atol=1e-6)
+
+
+def test_homography_pair_rejects_a_singular_homography(monkeypatch):
+  monkeypatch.setattr(main.cv2, "findHomography", lambda *args: (np.zeros((3, 3)), None))
+  pts = np.float32([[0, 0], [10, 5], [40, 30], [7, 90]])
+  with pytest.raises(np.linalg.LinAlgError):
+    main.homography_pair(pts, pts)
+
+
+def test_overlapping_topos_skips_candidates_without_a_homography(monkeypatch):
+  class References:
+    def get(self, path, size=840):
+      return {"w": 40, "h": 30, "original_w": 40, "original_h": 30}
+
+  class Catalog:
+    def crag(self, path):
+      return None
+
+  monkeypatch.setattr(main, "OVERLAP_MIN_INLIERS", 4)
+  monkeypatch.setattr(main, "reference_cache", References())
+  monkeypatch.setattr(main, "catalog", Catalog())
+  pts0 = np.float32([[0, 0], [10, 5], [40, 30], [7, 90], [60, 12]])
+  collinear = np.float32([[0, 0], [10, 0], [20, 0], [30, 0], [40, 0], [50, 0]])
+  overlaps = main.overlapping_topos(["a.jpg", "b.jpg"], [(pts0, pts0 + [2, -1]), (collinear, collinear)])
+  assert [overlap["path"] for overlap in overlaps] == ["a.jpg"]
+  assert np.allclose(np.reshape(overlaps[0]["homography_matrix"], (3, 3)), TRANSLATION, atol=1e-6)
@@ -0,0 +1,30 @@
+import cv2
+import numpy as np
+import pytest
+
+import main
+
+
+@pytest.mark.parametrize("size, is_jpeg, color, expected", [
+  # 4000x3000: 1/4 still leaves 1000 px for an 840 target, 1/8 doesn't
+  (840, True, False, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+  (840, True, True, cv2.IMREAD_REDUCED_COLOR_4),
+  (500, True, False, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+  (1500, True, False, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+  (2001, True, False, cv2.IMREAD_GRAYSCALE),
+  # only JPEG supports decoding at a reduced scale
+  (840, False, False, cv2.IMREAD_GRAYSCALE),
+  (840, False, True, cv2.IMREAD_COLOR),
+])
+def test_decode_flags(size, is_jpeg, color, expected):
+  assert main.decode_flags(4000, 3000, size, is_jpeg, color) == expected
+
+
+@pytest.mark.parametrize("extension", [".jpg", ".png"])
+def test_get_tensor_image_scales_the_long_side(extension):
+  ok, encoded = cv2.imencode(extension, np.full((1800, 2400, 3), 200, dtype=np.uint8))
+  tensor = main.get_tensor_image(encoded.tobytes(), 840)
+  assert (tensor["w"], tensor["h"]) == (840, 630)
+  assert (tensor["original_w"], tensor["original_h"]) == (2400, 1800)
+  assert tuple(tensor["gray"].shape) == (1, 1, 630, 840)
+  assert float(tensor["gray"].max()) == pytest.approx(200 / 255, abs=0.01)
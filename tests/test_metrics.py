@@ -0,0 +1,85 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+from prometheus_client import CollectorRegistry
+from prometheus_client.parser import text_string_to_metric_families
+
+import main
+
+
+def samples(text):
+  return {(sample.name, tuple(sorted(sample.labels.items()))): sample.value
+          for family in text_string_to_metric_families(text) for sample in family.samples}
+
+
+def test_counters_and_histograms():
+  metrics = main.Metrics("test_", CollectorRegistry())
+  metrics.inc("requests_total", {"route": "/region", "status": 200})
+  metrics.inc("requests_total", {"route": "/region", "status": 200}, 2)
+  metrics.observe("stage_duration_seconds", 0.02, {"stage": "decode"})
+  metrics.observe("stage_duration_seconds", 3, {"stage": "decode"})
+  found = samples(metrics.render().decode())
+  assert found[("test_requests_total", (("route", "/region"), ("status", "200")))] == 3
+  assert found[("test_stage_duration_seconds_bucket", (("le", "0.025"), ("stage", "decode")))] == 1
+  assert found[("test_stage_duration_seconds_bucket", (("le", "+Inf"), ("stage", "decode")))] == 2
+  assert found[("test_stage_duration_seconds_sum", (("stage", "decode"),))] == 3.02
+
+
+def test_label_values_are_escaped():
+  metrics = main.Metrics("test_", CollectorRegistry())
+  metrics.inc("requests_total", {"route": 'say "hi"\\\n'})
+  text = metrics.render().decode()
+  assert 'route="say \\"hi\\"\\\\\\n"' in text
+  assert samples(text)[("test_requests_total", (("route", 'say "hi"\\\n'),))] == 1
+
+
+def test_callbacks_are_read_on_scrape():
+  metrics = main.Metrics("test_", CollectorRegistry())
+  depth = [3]
+  lookups = {"hits": 5}
+  metrics.gauge("queue_depth", lambda: depth[0])
+  metrics.counter("cache_lookups_total", lambda: [({"result": "hits"}, lookups["hits"])])
+  assert samples(metrics.render().decode())[("test_queue_depth", ())] == 3
+
+  depth[0] = 1
+  lookups["hits"] = 8
+  found = samples(metrics.render().decode())
+  assert found[("test_queue_depth", ())] == 1
+  assert found[("test_cache_lookups_total", (("result", "hits"),))] == 8
+
+
+def test_workers_are_merged(tmp_path):
+  script = textwrap.dedent("""
+    import os
+    from prometheus_client import multiprocess
+    import main
+
+    main.metrics.gauge("inference_queue_depth", lambda: 4)
+    main.metrics.inc("requests_total", {"route": "/region"})
+    pid = os.fork()
+    if pid == 0:
+      main.metrics.inc("requests_total", {"route": "/region"}, 2)
+      main.metrics.refresh()
+      os._exit(0)
+    os.waitpid(pid, 0)
+    print("----")
+    print(main.metrics.render().decode())
+    print("----")
+    multiprocess.mark_process_dead(pid)
+    print(main.metrics.render().decode())
+  """)
+  env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path))
+  root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  output = subprocess.run([sys.executable, "-c", script], cwd=root, env=env,
+                          capture_output=True, text=True, check=True).stdout
+  # after whatever importing main prints
+  live, after_exit = [samples(text) for text in output.split("----\n")[1:]]
+
+  assert live[("topomatch_requests_total", (("route", "/region"),))] == 3
+  # one gauge per live worker
+  assert sorted(value for (name, labels), value in live.items() if name == "topomatch_inference_queue_depth") == [4, 4]
+  # an exited worker's counts stay, its gauges go
+  assert after_exit[("topomatch_requests_total", (("route", "/region"),))] == 3
+  assert len([name for name, labels in after_exit if name == "topomatch_inference_queue_depth"]) == 1
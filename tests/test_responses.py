@@ -0,0 +1,45 @@
+import json
+import struct
+
+import numpy as np
+
+import main
+
+RESPONSE = {
+  "matched_points": main.compact_points(np.float32([[1.5, 2], [3, 4]]), np.float32([[10, 20], [30, 40.25]])),
+  "homography_matrix": [1, 0, 0, 0, 1, 0, 0, 0, 1],
+  "image2": {"width": 840, "height": 630},
+}
+
+
+def test_json_format_expands_points():
+  body = json.loads(main.encode_response(RESPONSE, main.ResponseFormat.json).body)
+  assert body["matched_points"] == [
+    {"point1": {"x": 1.5, "y": 2}, "point2": {"x": 10, "y": 20}},
+    {"point1": {"x": 3, "y": 4}, "point2": {"x": 30, "y": 40.25}},
+  ]
+  assert body["homography_matrix"] == RESPONSE["homography_matrix"]
+
+
+def test_compact_format_keeps_flat_lists():
+  body = json.loads(main.encode_response(RESPONSE, main.ResponseFormat.compact).body)
+  assert body == {**RESPONSE, "matched_points": {"points1": [1.5, 2, 3, 4], "points2": [10, 20, 30, 40.25]}}
+
+
+def test_binary_format_layout():
+  response = main.encode_response(RESPONSE, main.ResponseFormat.binary)
+  assert response.media_type == "application/octet-stream"
+  body = response.body
+  (header_length,) = struct.unpack_from("<I", body)
+  header = json.loads(body[4:4 + header_length].decode())
+  assert header == {**RESPONSE, "matched_points": 2}
+  rows = np.frombuffer(body[4 + header_length:], dtype="<f4").reshape(-1, 4)
+  assert rows.tolist() == [[1.5, 2, 10, 20], [3, 4, 30, 40.25]]
+
+
+def test_binary_format_without_matches():
+  empty = {**RESPONSE, "matched_points": main.compact_points(np.zeros((0, 2)), np.zeros((0, 2)))}
+  body = main.encode_response(empty, main.ResponseFormat.binary).body
+  (header_length,) = struct.unpack_from("<I", body)
+  assert json.loads(body[4:4 + header_length])["matched_points"] == 0
+  assert len(body) == 4 + header_length
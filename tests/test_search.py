@@ -0,0 +1,122 @@
+import asyncio
+import base64
+import json
+
+import cv2
+import numpy as np
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.mark.parametrize("scores, expected", [
+  ([42], True),
+  ([30, 10, 5], True),
+  ([10, 30], True),
+  ([15, 10], True),
+  ([14, 10], False),
+  ([20, 20], False),
+  # a runner-up without inliers counts as one
+  ([2, 0], True),
+  ([1, 0], False),
+])
+def test_has_margin(monkeypatch, scores, expected):
+  monkeypatch.setattr(main, "SEARCH_MARGIN", 1.5)
+  assert main.has_margin(scores) is expected
+
+
+def test_exhaustive_search_loads_only_the_winner(monkeypatch):
+  matches = {
+    "a.jpg": (np.zeros((5, 2)), np.zeros((5, 2))),
+    "b.jpg": (np.zeros((9, 2)), np.zeros((9, 2))),
+    "c.jpg": (np.zeros((2, 2)), np.zeros((2, 2))),
+  }
+  loaded = []
+
+  async def match_candidates(query, compare_images):
+    return [matches[img] for img in compare_images]
+
+  class References:
+    def get(self, path, size=840):
+      loaded.append(path)
+      return {"path": path}
+
+  monkeypatch.setattr(main, "match_candidates", match_candidates)
+  monkeypatch.setattr(main, "reference_cache", References())
+  best, reference, best_matches, scores = asyncio.run(main.exhaustive_search(None, list(matches)))
+  assert (best, reference, best_matches) == ("b.jpg", {"path": "b.jpg"}, matches["b.jpg"])
+  assert scores == {"a.jpg": 5, "b.jpg": 9, "c.jpg": 2}
+  assert loaded == ["b.jpg"]
+
+
+@pytest.fixture
+def post(tmp_path, monkeypatch):
+  monkeypatch.chdir(tmp_path)
+  region = tmp_path / "images" / "stokowka"
+  region.mkdir(parents=True)
+  cv2.imwrite(str(region / "topo.jpg"), np.zeros((30, 40, 3), dtype=np.uint8))
+  monkeypatch.setattr(main, "catalog", main.RegionCatalog("./images"))
+  monkeypatch.setattr(main, "result_cache", main.ResultCache(8))
+  client = TestClient(main.app)
+  body = {"image_data": base64.b64encode(b"query").decode(), "folder_path": "stokowka"}
+  return lambda url: client.post(url, json=body)
+
+
+def test_stream_fails_before_starting_when_the_query_cant_be_prepared(post, monkeypatch):
+  async def prepare_region_query(*args):
+    raise HTTPException(status_code=503, detail="Inference queue is full")
+
+  monkeypatch.setattr(main, "prepare_region_query", prepare_region_query)
+  response = post("/find_matching_matrix/stream")
+  assert response.status_code == 503
+  assert response.json() == {"detail": "Inference queue is full"}
+
+
+def test_stream_reports_errors_after_starting_as_events(post, monkeypatch):
+  async def prepare_region_query(img_bytes, folder_path, compare_images, top_k, route):
+    return None, None, compare_images
+
+  async def match_candidates(query, compare_images):
+    raise HTTPException(status_code=504, detail="Inference timed out")
+
+  monkeypatch.setattr(main, "prepare_region_query", prepare_region_query)
+  monkeypatch.setattr(main, "match_candidates", match_candidates)
+  response = post("/find_matching_matrix/stream")
+  assert response.status_code == 200
+  events = [json.loads(line) for line in response.text.splitlines()]
+  assert events == [
+    {"event": "candidates", "candidates": ["./images/stokowka/topo.jpg"]},
+    {"event": "error", "status": 504, "detail": "Inference timed out"},
+  ]
+
+
+def test_overlap_search_fits_the_best_match_once(post, monkeypatch):
+  pts0 = np.float32([[0, 0], [10, 5], [40, 30], [7, 90], [60, 12]])
+  fitted = []
+  homography_pair = main.homography_pair
+
+  async def prepare_region_query(img_bytes, folder_path, compare_images, top_k, route):
+    return {"w": 40, "h": 30}, None, compare_images
+
+  async def match_candidates(query, compare_images):
+    return [(pts0, pts0 + [2, -1]) for _ in compare_images]
+
+  class References:
+    def get(self, path, size=840):
+      return {"w": 40, "h": 30, "original_w": 40, "original_h": 30}
+
+  def counting_homography_pair(*args):
+    fitted.append(args)
+    return homography_pair(*args)
+
+  monkeypatch.setattr(main, "OVERLAP_MIN_INLIERS", 4)
+  monkeypatch.setattr(main, "prepare_region_query", prepare_region_query)
+  monkeypatch.setattr(main, "match_candidates", match_candidates)
+  monkeypatch.setattr(main, "reference_cache", References())
+  monkeypatch.setattr(main, "homography_pair", counting_homography_pair)
+  response = post("/find_matching_matrix?overlap=1").json()
+  assert len(fitted) == 1
+  assert response["homography_matrix"] == response["overlaps"][0]["homography_matrix"]
+  assert response["homography_matrix_inverse"] == response["overlaps"][0]["homography_matrix_inverse"]
@@ -0,0 +1,66 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+import main
+
+
+def state(topo="./images/stokowka/topo.jpg"):
+  return {
+    "folder_path": "./images/stokowka",
+    "topo": topo,
+    "frame": np.arange(12, dtype=np.uint8).reshape(3, 4),
+    "pts0": np.float32([[1, 2], [3, 4]]),
+    "pts1": np.float32([[5, 6], [7, 8]]),
+  }
+
+
+@pytest.fixture(params=["memory", "directory"])
+def sessions(request, tmp_path):
+  return main.TrackingSessions(3, 60, str(tmp_path) if request.param == "directory" else None)
+
+
+def test_sessions_round_trip(sessions):
+  sessions.put("a", state())
+  session = sessions.get("a")
+  assert session["folder_path"] == "./images/stokowka"
+  assert session["topo"] == "./images/stokowka/topo.jpg"
+  assert session["frame"].tolist() == state()["frame"].tolist()
+  assert session["pts1"].tolist() == [[5, 6], [7, 8]]
+  assert sessions.get("b") is None
+  assert sessions.remove("a")
+  assert not sessions.remove("a")
+  assert sessions.get("a") is None
+
+
+def test_sessions_keep_the_most_recent(sessions, tmp_path):
+  for i, session_id in enumerate("abcd"):
+    sessions.put(session_id, state())
+    if sessions.directory:
+      # mtimes order the sessions on disk
+      os.utime(os.path.join(sessions.directory, f"{session_id}.npz"), (time.time() - 10 + i,) * 2)
+  sessions.put("b", state())
+  assert sessions.get("a") is None
+  assert all(sessions.get(session_id) is not None for session_id in "bcd")
+
+
+def test_directory_sessions_are_shared_and_expire(tmp_path):
+  sessions = main.TrackingSessions(8, 60, str(tmp_path))
+  sessions.put("a", state())
+  assert main.TrackingSessions(8, 60, str(tmp_path)).get("a")["topo"] == state()["topo"]
+  os.utime(tmp_path / "a.npz", (time.time() - 61,) * 2)
+  assert sessions.get("a") is None
+  assert not (tmp_path / "a.npz").exists()
+
+
+@pytest.mark.parametrize("session_id, valid", [
+  ("0123abcd", True),
+  ("phone_1-front", True),
+  ("", False),
+  ("../escape", False),
+  ("a" * 65, False),
+])
+def test_session_ids(session_id, valid):
+  assert main.TrackingSessions.valid_id(session_id) is valid